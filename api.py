@@ -1,18 +1,47 @@
-from fastapi import APIRouter
-from fastapi.responses import JSONResponse
-from typing import List
+from fastapi import APIRouter, Header, Query, Request, Response
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
+from sqlalchemy import func, select
+from typing import List, Literal, Optional
 
 from schemas import *
 from utils import *
 from models import *
+from session import get_pool_stats
+from metrics import query_budget
+from cache import *
+from catalog import CATALOG_COLUMNS, CATALOG_FORMATS, export_stream, import_table
+from jobs import create_delete_job, get_job, start_job
 
 menu_v1_router = APIRouter(prefix=path_prefix)
 
+
+async def delete_job_response(target: str, target_id: int, menu_id: int) -> JSONResponse:
+    """
+    Создание и запуск задачи удаления меню или подменю
+    """
+    job_id = await create_delete_job(target, target_id, menu_id)
+    if job_id is None:
+        return JSONResponse(
+            {"message": f"{target} not found", "detail": f"{target} not found"},
+            status_code=404,
+        )
+    if target == "menu":
+        await response_cache.invalidate_menu(menu_id, subtree=True)
+    else:
+        await response_cache.invalidate_submenu(menu_id, target_id, subtree=True)
+    start_job(job_id)
+    return JSONResponse(
+        {"job_id": str(job_id), "status": "pending"},
+        status_code=202,
+        headers={"Location": f"{path_prefix}/admin/jobs/{job_id}"},
+    )
+
 ######################
 ######## MENU ########
 ######################
 
 @menu_v1_router.post("/menus", tags=["menu"])
+@query_budget(3)
 async def create_menu(data: MainFieldsPy) -> JSONResponse:
     """
     Создание нового меню
@@ -20,6 +49,7 @@ async def create_menu(data: MainFieldsPy) -> JSONResponse:
     try:
         data = dict(data)
         menu_id = await create_row(data=data, table="menu")
+        await response_cache.invalidate(lists=[MENUS_KEY, MENUS_TREE_KEY])
         return JSONResponse(
             {"id": str(menu_id)} | data,
             status_code=201
@@ -29,59 +59,114 @@ async def create_menu(data: MainFieldsPy) -> JSONResponse:
     
 
 @menu_v1_router.get("/menus", tags=["menu"])
-async def menu_list() -> List[GetMenuPy]:
+@response_cache.cached(MENUS_KEY + PAGE_KEY, bypass=lambda params: wants_ndjson(params["accept"]))
+@query_budget(2)
+async def menu_list(
+    cursor: Optional[int] = None,
+    limit: int = Query(page_limit, ge=1, le=page_max_limit),
+    accept: Optional[str] = Header(None),
+) -> List[GetMenuPy]:
     """
-    Получение списка меню
+    Получение страницы списка меню; с Accept: application/x-ndjson -
+    построчная выдача всех меню после cursor
     """
     try:
-        menus = await get_rows(table="menu")
-        if menus.empty:
-            return []
-        return [GetMenuPy(**row) for row in menus.to_dict(orient="records")]
+        if wants_ndjson(accept):
+            return ndjson_response(
+                select(MenuPy.id, MenuPy.title, MenuPy.description).where(
+                    MenuPy.id > (cursor or 0),
+                    MenuPy.deleting.is_(False),
+                ).order_by(MenuPy.id),
+            )
+        menus = await get_rows(
+            table="menu",
+            conditions={"deleting": False},
+            cursor=cursor,
+            limit=limit + 1,
+            columns=CATALOG_COLUMNS["menu"],
+        )
+        return page_response(menus, limit)
     except Exception as exception:
         return JSONResponse({"message": exception}, status_code=400)
 
 
+@menu_v1_router.get("/menus/tree", tags=["menu"])
+@response_cache.cached(MENUS_TREE_KEY + PAGE_KEY)
+@query_budget(2)
+async def menu_tree_list(
+    cursor: Optional[int] = None,
+    limit: int = Query(page_limit, ge=1, le=page_max_limit),
+) -> List[TreeMenuPy]:
+    """
+    Получение страницы меню с подменю и блюдами
+    """
+    try:
+        menus = await get_menu_tree(cursor=cursor, limit=limit + 1)
+        return page_response(menus, limit)
+    except Exception as exception:
+        return JSONResponse({"message": str(exception)}, status_code=400)
+
+
+@menu_v1_router.get("/menus/{menu_id}/tree", tags=["menu"])
+@response_cache.cached(MENU_TREE_KEY)
+@query_budget(2)
+async def menu_tree(menu_id: int) -> TreeMenuPy:
+    """
+    Получение меню с подменю и блюдами: готовый документ по первичному ключу
+    """
+    try:
+        document = await get_menu_document(menu_id, "tree")
+        if document is None:
+            return JSONResponse(
+                {"message": "menu not found", "detail": "menu not found"},
+                status_code=404,
+            )
+        return Response(document, status_code=200, media_type="application/json")
+    except Exception as exception:
+        return JSONResponse({"message": str(exception)}, status_code=400)
+
+
+@menu_v1_router.get("/menus/{menu_id}/stats", tags=["menu"])
+@response_cache.cached(MENU_STATS_KEY)
+@query_budget(2)
+async def menu_stats(menu_id: int) -> MenuPriceStatsPy:
+    """
+    Число блюд и минимальная, максимальная и средняя цена
+    по меню и его подменю
+    """
+    try:
+        stats = await get_price_stats(menu_id)
+        if stats is None:
+            return JSONResponse(
+                {"message": "menu not found", "detail": "menu not found"},
+                status_code=404,
+            )
+        return ORJSONResponse(stats, status_code=200)
+    except Exception as exception:
+        return JSONResponse({"message": str(exception)}, status_code=400)
+
+
 @menu_v1_router.get("/menus/{menu_id}", tags=["menu"])
+@response_cache.cached(MENU_KEY)
+@query_budget(2)
 async def menu(menu_id: int) -> GetCountMenuPy:
     """
-    Получение меню
+    Получение меню: готовый документ по первичному ключу
     """
     try:
-        menu = await get_rows(
-            table="menu",
-            conditions={"id": menu_id},
-        )
-        if menu.empty:
+        document = await get_menu_document(menu_id, "detail")
+        if document is None:
             return JSONResponse(
                 {"message": "menu not found", "detail": "menu not found"},
                 status_code=404,
             )
-        menu = menu.to_dict(orient="records")[0]
-        with get_session() as session:
-            submenus = session.query(SubmenuPy).filter(
-                SubmenuPy.menu_id == menu_id
-            ).all()
-            submenus_ids = [subm.id for subm in submenus]
-            if submenus_ids:
-                dishes = session.query(DishPy).filter(
-                    DishPy.submenu_id.in_(submenus_ids)
-                ).join(
-                    SubmenuPy, DishPy.submenu_id == SubmenuPy.id
-                ).filter(
-                    SubmenuPy.menu_id == menu_id
-                ).all()
-            else:
-                dishes = []
-        menu["id"] = str(menu["id"])
-        menu["submenus_count"] = len(submenus)
-        menu["dishes_count"] = len(dishes)
-        return GetCountMenuPy(**menu)
+        return Response(document, status_code=200, media_type="application/json")
     except Exception as exception:
         return JSONResponse({"message": exception}, status_code=400)
     
 
 @menu_v1_router.patch("/menus/{menu_id}", tags=["menu"])
+@query_budget(3)
 async def update_menu(menu_id: int, data: MainFieldsPy) -> JSONResponse:
     """
     Обновление меню
@@ -92,22 +177,30 @@ async def update_menu(menu_id: int, data: MainFieldsPy) -> JSONResponse:
             data=data,
             table="menu",
             conditions={"id": menu_id},
+            menu_id=menu_id,
         )
+        await response_cache.invalidate_menu(menu_id)
         return JSONResponse(data, status_code=200)
     except Exception as exception:
         return JSONResponse({"message": exception}, status_code=400)
 
 
 @menu_v1_router.delete("/menus/{menu_id}", tags=["menu"])
-async def delete_menu(menu_id: int) -> JSONResponse:
+@query_budget(3)
+async def delete_menu(menu_id: int, background: bool = False) -> JSONResponse:
     """
-    Удаление меню
+    Удаление меню; с background - фоновой задачей пачками, меню
+    сразу скрывается из чтения, ответ 202 с id задачи
     """
     try:
+        if background:
+            return await delete_job_response("menu", menu_id, menu_id)
         await delete_row(
             table="menu",
             conditions={"id": menu_id},
+            menu_id=menu_id,
         )
+        await response_cache.invalidate_menu(menu_id, subtree=True)
         return JSONResponse({"message": "Меню удалено"}, status_code=200)
     except Exception as exception:
         return JSONResponse({"message": exception}, status_code=400)
@@ -118,16 +211,26 @@ async def delete_menu(menu_id: int) -> JSONResponse:
 #########################
 
 @menu_v1_router.post("/menus/{menu_id}/submenus", tags=["submenu"])
+@query_budget(4)
 async def create_submenu(menu_id: int, data: MainFieldsPy) -> JSONResponse:
     """
     Создание нового подменю
     """
     try:
         data = dict(data)
-        submenu_id = await create_row(
-            data=data | {"menu_id": menu_id},
-            table="submenu",
-        )
+        async with get_async_session() as session:
+            if not await menu_exists(menu_id, session=session):
+                return JSONResponse(
+                    {"message": "menu not found", "detail": "menu not found"},
+                    status_code=404,
+                )
+            submenu_id = await create_row(
+                data=data | {"menu_id": menu_id},
+                table="submenu",
+                menu_id=menu_id,
+                session=session,
+            )
+        await response_cache.invalidate_submenu(menu_id, submenu_id)
         return JSONResponse(
             {"id": str(submenu_id)} | data,
             status_code=201
@@ -136,52 +239,141 @@ async def create_submenu(menu_id: int, data: MainFieldsPy) -> JSONResponse:
         return JSONResponse({"message": exception}, status_code=400)
     
 
+@menu_v1_router.post("/menus/{menu_id}/submenus/bulk", tags=["submenu"])
+@query_budget(7)
+async def create_submenus(menu_id: int, data: List[BulkSubmenuPy]) -> JSONResponse:
+    """
+    Создание списка подменю с вложенными блюдами в одной транзакции
+    """
+    try:
+        async with get_async_session() as session:
+            if not await menu_exists(menu_id, session=session):
+                return JSONResponse(
+                    {"message": "menu not found", "detail": "menu not found"},
+                    status_code=404,
+                )
+            submenu_ids = await create_rows(
+                data=[
+                    {"title": submenu.title, "description": submenu.description, "menu_id": menu_id}
+                    for submenu in data
+                ],
+                table="submenu",
+                menu_id=menu_id,
+                session=session,
+            )
+            dishes = [
+                (submenu_id, dict(dish) | {"price": float(dish.price)})
+                for submenu, submenu_id in zip(data, submenu_ids)
+                for dish in submenu.dishes
+            ]
+            dish_ids = await create_rows(
+                data=[dish | {"submenu_id": submenu_id} for submenu_id, dish in dishes],
+                table="dish",
+                menu_id=menu_id,
+                session=session,
+            )
+        await response_cache.invalidate(
+            MENU_KEY.format(menu_id=menu_id),
+            MENU_TREE_KEY.format(menu_id=menu_id),
+            MENU_STATS_KEY.format(menu_id=menu_id),
+            lists=[SUBMENUS_KEY.format(menu_id=menu_id), MENUS_TREE_KEY],
+        )
+        created = {
+            submenu_id: {
+                "id": str(submenu_id),
+                "title": submenu.title,
+                "description": submenu.description,
+                "dishes": [],
+            }
+            for submenu, submenu_id in zip(data, submenu_ids)
+        }
+        for (submenu_id, dish), dish_id in zip(dishes, dish_ids):
+            created[submenu_id]["dishes"].append(
+                {"id": str(dish_id)} | dish | {"price": f"{dish['price']:.2f}"}
+            )
+        return JSONResponse(list(created.values()), status_code=201)
+    except Exception as exception:
+        return JSONResponse({"message": str(exception)}, status_code=400)
+
+
 @menu_v1_router.get("/menus/{menu_id}/submenus", tags=["submenu"])
-async def submenu_list() -> List[GetSubmenuPy]:
+@response_cache.cached(SUBMENUS_KEY + PAGE_KEY, bypass=lambda params: wants_ndjson(params["accept"]))
+@query_budget(2)
+async def submenu_list(
+    menu_id: int,
+    cursor: Optional[int] = None,
+    limit: int = Query(page_limit, ge=1, le=page_max_limit),
+    accept: Optional[str] = Header(None),
+) -> List[GetSubmenuPy]:
     """
-    Получение списка подменю
+    Получение страницы списка подменю; с Accept: application/x-ndjson -
+    построчная выдача всех подменю после cursor
     """
     try:
-        submenus = await get_rows(table="submenu")
-        if submenus.empty:
-            return []
-        return [GetSubmenuPy(**row) for row in submenus.to_dict(orient="records")]
+        query = select(
+            SubmenuPy.id, SubmenuPy.title, SubmenuPy.description, SubmenuPy.menu_id
+        ).join(
+            MenuPy, SubmenuPy.menu_id == MenuPy.id
+        ).where(
+            SubmenuPy.menu_id == menu_id,
+            SubmenuPy.deleting.is_(False),
+            MenuPy.deleting.is_(False),
+            SubmenuPy.id > (cursor or 0),
+        ).order_by(
+            SubmenuPy.id
+        )
+        if wants_ndjson(accept):
+            return ndjson_response(query)
+        async with get_async_session() as session:
+            submenus = (await session.execute(
+                query.limit(limit + 1)
+            )).mappings().all()
+        return page_response(list(map(dict, submenus)), limit)
     except Exception as exception:
         return JSONResponse({"message": exception}, status_code=400)
 
 
 @menu_v1_router.get("/menus/{menu_id}/submenus/{submenu_id}", tags=["submenu"])
+@response_cache.cached(SUBMENU_KEY)
+@query_budget(2)
 async def submenu(menu_id: int, submenu_id: int) -> GetCountSubmenuPy:
     """
     Получение подменю
     """
     try:
-        submenu = await get_rows(
-            table="submenu",
-            conditions={"menu_id": menu_id, "id": submenu_id},
-        )
-        if submenu.empty:
+        async with get_async_session() as session:
+            submenu = (await session.execute(
+                select(
+                    SubmenuPy.id,
+                    SubmenuPy.title,
+                    SubmenuPy.description,
+                    SubmenuPy.menu_id,
+                    select(func.count(DishPy.id)).where(
+                        DishPy.submenu_id == SubmenuPy.id
+                    ).scalar_subquery().label("dishes_count"),
+                ).join(
+                    MenuPy, SubmenuPy.menu_id == MenuPy.id
+                ).where(
+                    SubmenuPy.id == submenu_id,
+                    SubmenuPy.menu_id == menu_id,
+                    SubmenuPy.deleting.is_(False),
+                    MenuPy.deleting.is_(False),
+                )
+            )).mappings().first()
+        if submenu is None:
             return JSONResponse(
                 {"message": "submenu not found", "detail": "submenu not found"},
                 status_code=404,
             )
-        submenu = submenu.to_dict(orient="records")[0]
-        with get_session() as session:
-            dishes = session.query(DishPy).filter(
-                DishPy.submenu_id == submenu_id
-            ).join(
-                SubmenuPy, DishPy.submenu_id == SubmenuPy.id
-            ).filter(
-                SubmenuPy.menu_id == menu_id
-            ).all()
+        submenu = dict(submenu)
         submenu["id"] = str(submenu["id"])
-        submenu["dishes_count"] = len(dishes)
-        return GetCountSubmenuPy(**submenu)
+        return ORJSONResponse(submenu, status_code=200)
     except Exception as exception:
         return JSONResponse({"message": exception}, status_code=400)
     
 
 @menu_v1_router.patch("/menus/{menu_id}/submenus/{submenu_id}", tags=["submenu"])
+@query_budget(3)
 async def update_submenu(menu_id: int, submenu_id: int, data: MainFieldsPy) -> JSONResponse:
     """
     Обновление подменю
@@ -192,22 +384,30 @@ async def update_submenu(menu_id: int, submenu_id: int, data: MainFieldsPy) -> J
             data=data,
             table="submenu",
             conditions={"id": submenu_id, "menu_id": menu_id},
+            menu_id=menu_id,
         )
+        await response_cache.invalidate_submenu(menu_id, submenu_id)
         return JSONResponse(data, status_code=200)
     except Exception as exception:
         return JSONResponse({"message": exception}, status_code=400)
 
 
 @menu_v1_router.delete("/menus/{menu_id}/submenus/{submenu_id}", tags=["submenu"])
-async def delete_menu(menu_id: int, submenu_id: int) -> JSONResponse:
+@query_budget(3)
+async def delete_menu(menu_id: int, submenu_id: int, background: bool = False) -> JSONResponse:
     """
-    Удаление подменю
+    Удаление подменю; с background - фоновой задачей пачками, подменю
+    сразу скрывается из чтения, ответ 202 с id задачи
     """
     try:
+        if background:
+            return await delete_job_response("submenu", submenu_id, menu_id)
         await delete_row(
             table="submenu",
             conditions={"id": submenu_id, "menu_id": menu_id},
+            menu_id=menu_id,
         )
+        await response_cache.invalidate_submenu(menu_id, submenu_id, subtree=True)
         return JSONResponse({"message": "Подменю удалено"}, status_code=200)
     except Exception as exception:
         return JSONResponse({"message": exception}, status_code=400)
@@ -218,7 +418,17 @@ async def delete_menu(menu_id: int, submenu_id: int) -> JSONResponse:
 ######## DISH ########
 ######################
 
+# Колонки блюда в ответах: цена уже строкой из запроса
+dish_columns = (
+    DishPy.id,
+    DishPy.title,
+    DishPy.description,
+    price_text(DishPy.price),
+    DishPy.submenu_id,
+)
+
 @menu_v1_router.post("/menus/{menu_id}/submenus/{submenu_id}/dishes", tags=["dish"])
+@query_budget(4)
 async def create_dish(menu_id: int, submenu_id: int, data: MainDishPy) -> JSONResponse:
     """
     Создание нового блюда
@@ -227,10 +437,19 @@ async def create_dish(menu_id: int, submenu_id: int, data: MainDishPy) -> JSONRe
         data = dict(data)
         if isinstance(data["price"], str):
             data["price"] = float(data["price"])
-        dish_id = await create_row(
-            data=data | {"submenu_id": submenu_id},
-            table="dish",
-        )
+        async with get_async_session() as session:
+            if not await submenu_exists(menu_id, submenu_id, session=session):
+                return JSONResponse(
+                    {"message": "submenu not found", "detail": "submenu not found"},
+                    status_code=404,
+                )
+            dish_id = await create_row(
+                data=data | {"submenu_id": submenu_id},
+                table="dish",
+                menu_id=menu_id,
+                session=session,
+            )
+        await response_cache.invalidate_dish(menu_id, submenu_id, dish_id)
         data["price"] = f"{data['price']:.2f}"
         return JSONResponse(
             {"id": str(dish_id)} | data,
@@ -240,44 +459,181 @@ async def create_dish(menu_id: int, submenu_id: int, data: MainDishPy) -> JSONRe
         return JSONResponse({"message": exception}, status_code=400)
     
 
+@menu_v1_router.post("/menus/{menu_id}/submenus/{submenu_id}/dishes/bulk", tags=["dish"])
+@query_budget(4)
+async def create_dishes(menu_id: int, submenu_id: int, data: List[MainDishPy]) -> JSONResponse:
+    """
+    Создание списка блюд одним запросом
+    """
+    try:
+        dishes = [dict(dish) | {"price": float(dish.price)} for dish in data]
+        async with get_async_session() as session:
+            if not await submenu_exists(menu_id, submenu_id, session=session):
+                return JSONResponse(
+                    {"message": "submenu not found", "detail": "submenu not found"},
+                    status_code=404,
+                )
+            dish_ids = await create_rows(
+                data=[dish | {"submenu_id": submenu_id} for dish in dishes],
+                table="dish",
+                menu_id=menu_id,
+                session=session,
+            )
+        await response_cache.invalidate_submenu(menu_id, submenu_id, subtree=True)
+        return JSONResponse(
+            [
+                {"id": str(dish_id)} | dish | {"price": f"{dish['price']:.2f}"}
+                for dish, dish_id in zip(dishes, dish_ids)
+            ],
+            status_code=201
+        )
+    except Exception as exception:
+        return JSONResponse({"message": str(exception)}, status_code=400)
+
+
+@menu_v1_router.patch("/menus/{menu_id}/submenus/{submenu_id}/dishes/bulk", tags=["dish"])
+@query_budget(4)
+async def update_dishes(menu_id: int, submenu_id: int, data: BulkDishUpdatePy) -> JSONResponse:
+    """
+    Изменение цен блюд подменю одним запросом: prices - новые цены
+    по id, либо percent - изменение в процентах всех блюд или блюд ids
+    """
+    try:
+        if bool(data.prices) == (data.percent is not None):
+            return JSONResponse(
+                {"message": "either prices or percent is required"},
+                status_code=400,
+            )
+        async with get_async_session() as session:
+            if not await submenu_exists(menu_id, submenu_id, session=session):
+                return JSONResponse(
+                    {"message": "submenu not found", "detail": "submenu not found"},
+                    status_code=404,
+                )
+            conditions = {"submenu_id": submenu_id}
+            if data.prices:
+                dish_ids = await update_rows(
+                    data=[{"id": dish.id, "price": float(dish.price)} for dish in data.prices],
+                    table="dish",
+                    conditions=conditions,
+                    menu_id=menu_id,
+                    session=session,
+                )
+            else:
+                if data.ids:
+                    conditions["id"] = data.ids
+                dish_ids = await scale_rows(
+                    column="price",
+                    factor=1 + data.percent / 100,
+                    table="dish",
+                    conditions=conditions,
+                    menu_id=menu_id,
+                    session=session,
+                )
+        await response_cache.invalidate_submenu(menu_id, submenu_id, subtree=True)
+        return JSONResponse({"ids": [str(dish_id) for dish_id in dish_ids]}, status_code=200)
+    except Exception as exception:
+        return JSONResponse({"message": str(exception)}, status_code=400)
+
+
+@menu_v1_router.delete("/menus/{menu_id}/submenus/{submenu_id}/dishes/bulk", tags=["dish"])
+@query_budget(4)
+async def delete_dishes(
+    menu_id: int,
+    submenu_id: int,
+    ids: List[int] = Query(...),
+) -> JSONResponse:
+    """
+    Удаление блюд подменю по списку id одним запросом
+    """
+    try:
+        async with get_async_session() as session:
+            if not await submenu_exists(menu_id, submenu_id, session=session):
+                return JSONResponse(
+                    {"message": "submenu not found", "detail": "submenu not found"},
+                    status_code=404,
+                )
+            dish_ids = await delete_row(
+                table="dish",
+                conditions={"id": ids, "submenu_id": submenu_id},
+                menu_id=menu_id,
+                session=session,
+            )
+        await response_cache.invalidate_submenu(menu_id, submenu_id, subtree=True)
+        return JSONResponse({"ids": [str(dish_id) for dish_id in dish_ids]}, status_code=200)
+    except Exception as exception:
+        return JSONResponse({"message": str(exception)}, status_code=400)
+
+
 @menu_v1_router.get("/menus/{menu_id}/submenus/{submenu_id}/dishes", tags=["dish"])
-async def dish_list() -> List[GetDishPy]:
+@response_cache.cached(DISHES_KEY + PAGE_KEY, bypass=lambda params: wants_ndjson(params["accept"]))
+@query_budget(2)
+async def dish_list(
+    menu_id: int,
+    submenu_id: int,
+    cursor: Optional[int] = None,
+    limit: int = Query(page_limit, ge=1, le=page_max_limit),
+    accept: Optional[str] = Header(None),
+) -> List[GetDishPy]:
     """
-    Получение списка блюд
+    Получение страницы списка блюд; с Accept: application/x-ndjson -
+    построчная выдача всех блюд после cursor
     """
     try:
-        dishes = await get_rows(table="dish")
-        if dishes.empty:
-            return []
-        return [GetDishPy(**row) for row in dishes.to_dict(orient="records")]
+        query = select(*dish_columns).join(
+            SubmenuPy, DishPy.submenu_id == SubmenuPy.id
+        ).where(
+            DishPy.submenu_id == submenu_id,
+            SubmenuPy.menu_id == menu_id,
+            SubmenuPy.deleting.is_(False),
+            DishPy.id > (cursor or 0),
+        ).order_by(
+            DishPy.id
+        )
+        if wants_ndjson(accept):
+            return ndjson_response(query)
+        async with get_async_session() as session:
+            dishes = (await session.execute(
+                query.limit(limit + 1)
+            )).mappings().all()
+        return page_response(list(map(dict, dishes)), limit)
     except Exception as exception:
         return JSONResponse({"message": exception}, status_code=400)
 
 
 @menu_v1_router.get("/menus/{menu_id}/submenus/{submenu_id}/dishes/{dish_id}", tags=["dish"])
+@response_cache.cached(DISH_KEY)
+@query_budget(2)
 async def dish(menu_id: int, submenu_id: int, dish_id: int) -> GetDishPy:
     """
     Получение блюда
     """
     try:
-        dish = await get_rows(
-            table="dish",
-            conditions={"id": dish_id, "submenu_id": submenu_id},
-        )
-        if dish.empty:
+        async with get_async_session() as session:
+            dish = (await session.execute(
+                select(*dish_columns).join(
+                    SubmenuPy, DishPy.submenu_id == SubmenuPy.id
+                ).where(
+                    DishPy.id == dish_id,
+                    DishPy.submenu_id == submenu_id,
+                    SubmenuPy.menu_id == menu_id,
+                    SubmenuPy.deleting.is_(False),
+                )
+            )).mappings().first()
+        if dish is None:
             return JSONResponse(
                 {"message": "dish not found", "detail": "dish not found"},
                 status_code=404,
             )
-        dish = dish.to_dict(orient="records")[0]
+        dish = dict(dish)
         dish["id"] = str(dish["id"])
-        dish["price"] = f"{dish['price']:.2f}"
-        return GetDishPy(**dish)
+        return ORJSONResponse(dish, status_code=200)
     except Exception as exception:
         return JSONResponse({"message": exception}, status_code=400)
     
 
 @menu_v1_router.patch("/menus/{menu_id}/submenus/{submenu_id}/dishes/{dish_id}", tags=["dish"])
+@query_budget(4)
 async def update_dish(
     menu_id: int,
     submenu_id: int,
@@ -289,26 +645,170 @@ async def update_dish(
     """
     try:
         data = dict(data)
-        await update_row(
-            data=data | {"submenu_id": submenu_id},
-            table="dish",
-            conditions={"id": dish_id, "submenu_id": submenu_id},
-        )
+        async with get_async_session() as session:
+            if not await submenu_exists(menu_id, submenu_id, session=session):
+                return JSONResponse(
+                    {"message": "submenu not found", "detail": "submenu not found"},
+                    status_code=404,
+                )
+            await update_row(
+                data=data | {"submenu_id": submenu_id},
+                table="dish",
+                conditions={"id": dish_id, "submenu_id": submenu_id},
+                menu_id=menu_id,
+                session=session,
+            )
+        await response_cache.invalidate_dish(menu_id, submenu_id, dish_id)
         return JSONResponse(data, status_code=200)
     except Exception as exception:
         return JSONResponse({"message": exception}, status_code=400)
 
 
 @menu_v1_router.delete("/menus/{menu_id}/submenus/{submenu_id}/dishes/{dish_id}", tags=["dish"])
+@query_budget(4)
 async def delete_dish(menu_id: int, submenu_id: int, dish_id: int) -> JSONResponse:
     """
     Удаление блюда
     """
     try:
-        await delete_row(
-            table="dish",
-            conditions={"id": dish_id, "submenu_id": submenu_id},
-        )
+        async with get_async_session() as session:
+            if not await submenu_exists(menu_id, submenu_id, session=session):
+                return JSONResponse(
+                    {"message": "submenu not found", "detail": "submenu not found"},
+                    status_code=404,
+                )
+            await delete_row(
+                table="dish",
+                conditions={"id": dish_id, "submenu_id": submenu_id},
+                menu_id=menu_id,
+                session=session,
+            )
+        await response_cache.invalidate_dish(menu_id, submenu_id, dish_id)
         return JSONResponse({"message": "Блюдо удалено"}, status_code=200)
     except Exception as exception:
         return JSONResponse({"message": exception}, status_code=400)
+
+
+########################
+######## SEARCH ########
+########################
+
+@menu_v1_router.get("/search/dishes", tags=["search"])
+@query_budget(1)
+async def search_dish_list(
+    q: str = Query(..., min_length=1, max_length=256),
+    menu_id: Optional[int] = None,
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(page_limit, ge=1, le=page_max_limit),
+) -> List[SearchDishPy]:
+    """
+    Поиск блюд по названию и описанию блюда и названию подменю, по
+    префиксам слов; X-Next-Offset - смещение следующей страницы
+    """
+    try:
+        if search_query(q) is None:
+            return JSONResponse({"message": "empty search query"}, status_code=400)
+        dishes = await search_dishes(
+            q,
+            menu_id=menu_id,
+            min_price=min_price,
+            max_price=max_price,
+            offset=offset,
+            limit=limit + 1,
+        )
+        headers = {}
+        if len(dishes) > limit:
+            dishes = dishes[:limit]
+            headers["X-Next-Offset"] = str(offset + limit)
+        return ORJSONResponse(dishes, headers=headers)
+    except Exception as exception:
+        return JSONResponse({"message": str(exception)}, status_code=400)
+
+
+#######################
+######## ADMIN ########
+#######################
+
+@menu_v1_router.get("/admin/catalog/{table}", tags=["admin"])
+async def export_catalog_table(
+    table: Literal["menu", "submenu", "dish"],
+    format: Literal["csv", "json"] = "csv",
+) -> StreamingResponse:
+    """
+    Выгрузка таблицы каталога через COPY
+    """
+    return StreamingResponse(
+        export_stream(table, fmt=format),
+        media_type=CATALOG_FORMATS[format],
+    )
+
+
+@menu_v1_router.post("/admin/catalog/{table}", tags=["admin"])
+@query_budget(7)
+async def import_catalog_table(
+    request: Request,
+    table: Literal["menu", "submenu", "dish"],
+    format: Literal["csv", "json"] = "csv",
+) -> JSONResponse:
+    """
+    Загрузка таблицы каталога через COPY с обновлением записей по id
+    """
+    try:
+        rows = await import_table(
+            table,
+            source=(chunk async for chunk in request.stream() if chunk),
+            fmt=format,
+        )
+        await response_cache.invalidate_all()
+        return JSONResponse({"table": table, "rows": rows}, status_code=200)
+    except Exception as exception:
+        return JSONResponse({"message": str(exception)}, status_code=400)
+
+
+@menu_v1_router.get("/admin/jobs/{job_id}", tags=["admin"])
+@query_budget(1)
+async def delete_job_status(job_id: int) -> JSONResponse:
+    """
+    Состояние фоновой задачи удаления
+    """
+    try:
+        job = await get_job(job_id)
+        if job is None:
+            return JSONResponse(
+                {"message": "job not found", "detail": "job not found"},
+                status_code=404,
+            )
+        return JSONResponse(
+            job | {key: str(job[key]) for key in ("id", "target_id", "menu_id")},
+            status_code=200,
+        )
+    except Exception as exception:
+        return JSONResponse({"message": str(exception)}, status_code=400)
+
+
+#########################
+######## SERVICE ########
+#########################
+
+@menu_v1_router.get("/service/pool", tags=["service"])
+@query_budget(0)
+async def pool_stats() -> JSONResponse:
+    """
+    Состояние пулов соединений с базой данных
+    """
+    return JSONResponse(get_pool_stats(), status_code=200)
+
+
+@menu_v1_router.get("/service/cache", tags=["service"])
+@query_budget(0)
+async def cache_stats() -> JSONResponse:
+    """
+    Счётчики попаданий и промахов кеша ответов и полученных
+    уведомлений о сбросе от других процессов
+    """
+    return JSONResponse(
+        response_cache.stats() | {"notifications": invalidation_listener.received},
+        status_code=200,
+    )
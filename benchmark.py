@@ -0,0 +1,552 @@
+import argparse
+import asyncio
+import json
+import math
+import random
+import resource
+import sys
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from sqlalchemy import event, text
+
+from cache import CacheBackend, response_cache
+from jobs import running
+from main import app
+from session import db_engine_async, db_engines_replica, get_async_session, path_prefix
+from utils import bump_versions
+from warmup import asgi_request
+
+# Сценарии выполняются по порядку: создающие раньше удаляющих
+Scenario = Callable[["Benchmark"], Awaitable[int]]
+
+
+class QueryCounter:
+    """
+    Счётчик запросов к базе через асинхронный движок и реплики
+    """
+
+    def __init__(self):
+        self.count = 0
+        for engine in (db_engine_async, *db_engines_replica):
+            event.listen(engine.sync_engine, "before_cursor_execute", self.on_execute)
+
+    def on_execute(self, *args) -> None:
+        self.count += 1
+
+
+def percentile(values: List[float], share: float) -> float:
+    """
+    Перцентиль по ближайшему рангу
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(math.ceil(share * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def seed_catalog(menus: int, submenus: int, dishes: int, schema: str = "public") -> None:
+    """
+    Заполнение базы синтетическим каталогом: menus меню, по submenus
+    подменю в меню и по dishes блюд в подменю; прежний каталог удаляется
+    """
+    async with get_async_session() as session:
+        await session.execute(
+            text(f"TRUNCATE {schema}.menu, {schema}.submenu, {schema}.dish RESTART IDENTITY CASCADE")
+        )
+        await session.execute(
+            text(
+                f"""
+                INSERT INTO {schema}.menu (title, description)
+                SELECT 'Menu ' || n, 'Synthetic menu ' || n
+                FROM generate_series(1, :menus) AS n
+                """
+            ),
+            {"menus": menus},
+        )
+        await session.execute(
+            text(
+                f"""
+                INSERT INTO {schema}.submenu (title, description, menu_id)
+                SELECT 'Submenu ' || n, 'Synthetic submenu ' || n, m.id
+                FROM {schema}.menu m, generate_series(1, :submenus) AS n
+                ORDER BY m.id, n
+                """
+            ),
+            {"submenus": submenus},
+        )
+        await session.execute(
+            text(
+                f"""
+                INSERT INTO {schema}.dish (title, description, price, submenu_id)
+                SELECT 'Dish ' || n, 'Synthetic dish ' || n,
+                       round((1 + random() * 99)::numeric, 2), s.id
+                FROM {schema}.submenu s, generate_series(1, :dishes) AS n
+                ORDER BY s.id, n
+                """
+            ),
+            {"dishes": dishes},
+        )
+        menu_ids = (await session.execute(text(f"SELECT id FROM {schema}.menu"))).scalars().all()
+        submenu_ids = (await session.execute(text(f"SELECT id FROM {schema}.submenu"))).scalars().all()
+        await bump_versions(
+            menu_ids=menu_ids,
+            catalog=True,
+            submenu_ids=submenu_ids,
+            schema=schema,
+            session=session,
+        )
+        await session.execute(text(f"ANALYZE {schema}.menu, {schema}.submenu, {schema}.dish"))
+    await response_cache.invalidate_all()
+
+
+class Benchmark:
+    """
+    Прогон сценариев с заданной параллельностью и сбор метрик
+    """
+
+    def __init__(self, rng: random.Random, counter: QueryCounter):
+        self.rng = rng
+        self.counter = counter
+        self.submenus: List[Tuple[int, int]] = []
+        self.dishes: List[Tuple[int, int, int]] = []
+        self.created_menus: List[int] = []
+        self.created_submenus: List[Tuple[int, int]] = []
+        self.created_dishes: List[Tuple[int, int, int]] = []
+        self.jobs: List[int] = []
+        self.menu_csv = b""
+
+    async def load_catalog(self, schema: str = "public") -> None:
+        async with get_async_session() as session:
+            self.submenus = [
+                tuple(row) for row in await session.execute(
+                    text(f"SELECT id, menu_id FROM {schema}.submenu ORDER BY id")
+                )
+            ]
+            self.dishes = [
+                tuple(row) for row in await session.execute(
+                    text(
+                        f"""
+                        SELECT d.id, d.submenu_id, s.menu_id
+                        FROM {schema}.dish d
+                        JOIN {schema}.submenu s ON s.id = d.submenu_id
+                        ORDER BY d.id
+                        """
+                    )
+                )
+            ]
+        if not self.dishes:
+            raise ValueError("catalog is empty, run with --seed")
+        status, self.menu_csv = await asgi_request(app, "GET", f"{path_prefix}/admin/catalog/menu")
+
+    async def request(self, method: str, path: str, data: Any = None, **kwargs) -> Tuple[int, bytes]:
+        return await asgi_request(app, method, path_prefix + path, data, **kwargs)
+
+    def submenu(self) -> Tuple[int, int]:
+        return self.rng.choice(self.submenus)
+
+    def dish(self) -> Tuple[int, int, int]:
+        return self.rng.choice(self.dishes)
+
+    async def run(
+        self, scenario: Scenario, requests: int, concurrency: int
+    ) -> Dict[str, Any]:
+        """
+        requests вызовов сценария в concurrency параллельных задачах
+        """
+        latencies: List[float] = []
+        errors = 0
+        remaining = requests
+
+        async def worker() -> None:
+            nonlocal remaining, errors
+            while remaining > 0:
+                remaining -= 1
+                started = time.perf_counter()
+                status = await scenario(self)
+                latencies.append(time.perf_counter() - started)
+                if status >= 400:
+                    errors += 1
+
+        queries = self.counter.count
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        return {
+            "requests": len(latencies),
+            "errors": errors,
+            "rps": len(latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "queries_per_request": (self.counter.count - queries) / max(len(latencies), 1),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+
+######################
+###### SCENARIOS #####
+######################
+
+async def menu_list(bench: Benchmark) -> int:
+    return (await bench.request("GET", "/menus"))[0]
+
+
+async def menu_tree_list(bench: Benchmark) -> int:
+    return (await bench.request("GET", "/menus/tree?limit=10"))[0]
+
+
+async def menu_detail(bench: Benchmark) -> int:
+    submenu_id, menu_id = bench.submenu()
+    return (await bench.request("GET", f"/menus/{menu_id}"))[0]
+
+
+async def menu_tree(bench: Benchmark) -> int:
+    submenu_id, menu_id = bench.submenu()
+    return (await bench.request("GET", f"/menus/{menu_id}/tree"))[0]
+
+
+async def menu_stats(bench: Benchmark) -> int:
+    submenu_id, menu_id = bench.submenu()
+    return (await bench.request("GET", f"/menus/{menu_id}/stats"))[0]
+
+
+async def submenu_list(bench: Benchmark) -> int:
+    submenu_id, menu_id = bench.submenu()
+    return (await bench.request("GET", f"/menus/{menu_id}/submenus"))[0]
+
+
+async def submenu_detail(bench: Benchmark) -> int:
+    submenu_id, menu_id = bench.submenu()
+    return (await bench.request("GET", f"/menus/{menu_id}/submenus/{submenu_id}"))[0]
+
+
+async def dish_list(bench: Benchmark) -> int:
+    submenu_id, menu_id = bench.submenu()
+    return (await bench.request("GET", f"/menus/{menu_id}/submenus/{submenu_id}/dishes"))[0]
+
+
+async def dish_stream(bench: Benchmark) -> int:
+    submenu_id, menu_id = bench.submenu()
+    status, body = await bench.request(
+        "GET",
+        f"/menus/{menu_id}/submenus/{submenu_id}/dishes",
+        headers={"Accept": "application/x-ndjson"},
+    )
+    return status
+
+
+async def dish_detail(bench: Benchmark) -> int:
+    dish_id, submenu_id, menu_id = bench.dish()
+    return (await bench.request(
+        "GET", f"/menus/{menu_id}/submenus/{submenu_id}/dishes/{dish_id}"
+    ))[0]
+
+
+async def search_dishes(bench: Benchmark) -> int:
+    submenu_id, menu_id = bench.submenu()
+    return (await bench.request(
+        "GET", f"/search/dishes?q=dish&menu_id={menu_id}&max_price=50&limit=10"
+    ))[0]
+
+
+async def create_menu(bench: Benchmark) -> int:
+    status, body = await bench.request(
+        "POST", "/menus", {"title": "Bench menu", "description": "Benchmark"}
+    )
+    if status == 201:
+        bench.created_menus.append(int(json.loads(body)["id"]))
+    return status
+
+
+async def create_submenu(bench: Benchmark) -> int:
+    submenu_id, menu_id = bench.submenu()
+    status, body = await bench.request(
+        "POST",
+        f"/menus/{menu_id}/submenus",
+        {"title": "Bench submenu", "description": "Benchmark"},
+    )
+    if status == 201:
+        bench.created_submenus.append((int(json.loads(body)["id"]), menu_id))
+    return status
+
+
+async def create_submenus_bulk(bench: Benchmark) -> int:
+    submenu_id, menu_id = bench.submenu()
+    status, body = await bench.request(
+        "POST",
+        f"/menus/{menu_id}/submenus/bulk",
+        [
+            {
+                "title": "Bench bulk submenu",
+                "description": "Benchmark",
+                "dishes": [
+                    {"title": "Bench bulk dish", "description": "Benchmark", "price": "1.50"}
+                    for _ in range(10)
+                ],
+            },
+        ],
+    )
+    if status == 201:
+        for submenu in json.loads(body):
+            bench.created_submenus.append((int(submenu["id"]), menu_id))
+    return status
+
+
+async def create_dish(bench: Benchmark) -> int:
+    submenu_id, menu_id = bench.submenu()
+    status, body = await bench.request(
+        "POST",
+        f"/menus/{menu_id}/submenus/{submenu_id}/dishes",
+        {"title": "Bench dish", "description": "Benchmark", "price": "9.99"},
+    )
+    if status == 201:
+        bench.created_dishes.append((int(json.loads(body)["id"]), submenu_id, menu_id))
+    return status
+
+
+async def create_dishes_bulk(bench: Benchmark) -> int:
+    submenu_id, menu_id = bench.submenu()
+    status, body = await bench.request(
+        "POST",
+        f"/menus/{menu_id}/submenus/{submenu_id}/dishes/bulk",
+        [{"title": "Bench bulk dish", "description": "Benchmark", "price": "1.50"} for _ in range(10)],
+    )
+    if status == 201:
+        for dish in json.loads(body):
+            bench.created_dishes.append((int(dish["id"]), submenu_id, menu_id))
+    return status
+
+
+async def update_menu(bench: Benchmark) -> int:
+    submenu_id, menu_id = bench.submenu()
+    return (await bench.request(
+        "PATCH", f"/menus/{menu_id}", {"title": f"Menu {menu_id}", "description": "Updated"}
+    ))[0]
+
+
+async def update_submenu(bench: Benchmark) -> int:
+    submenu_id, menu_id = bench.submenu()
+    return (await bench.request(
+        "PATCH",
+        f"/menus/{menu_id}/submenus/{submenu_id}",
+        {"title": f"Submenu {submenu_id}", "description": "Updated"},
+    ))[0]
+
+
+async def update_dish(bench: Benchmark) -> int:
+    dish_id, submenu_id, menu_id = bench.dish()
+    return (await bench.request(
+        "PATCH",
+        f"/menus/{menu_id}/submenus/{submenu_id}/dishes/{dish_id}",
+        {"title": f"Dish {dish_id}", "description": "Updated", "price": "%.2f" % bench.rng.uniform(1, 100)},
+    ))[0]
+
+
+async def update_dishes_bulk(bench: Benchmark) -> int:
+    submenu_id, menu_id = bench.submenu()
+    return (await bench.request(
+        "PATCH", f"/menus/{menu_id}/submenus/{submenu_id}/dishes/bulk", {"percent": 1}
+    ))[0]
+
+
+async def delete_dishes_bulk(bench: Benchmark) -> int:
+    while len(bench.created_dishes) < 10:
+        await create_dishes_bulk(bench)
+    dish_id, submenu_id, menu_id = bench.created_dishes[-1]
+    dish_ids = []
+    while bench.created_dishes and bench.created_dishes[-1][1] == submenu_id and len(dish_ids) < 10:
+        dish_ids.append(bench.created_dishes.pop()[0])
+    query = "&".join(f"ids={dish_id}" for dish_id in dish_ids)
+    return (await bench.request(
+        "DELETE", f"/menus/{menu_id}/submenus/{submenu_id}/dishes/bulk?{query}"
+    ))[0]
+
+
+async def delete_dish(bench: Benchmark) -> int:
+    if not bench.created_dishes:
+        await create_dish(bench)
+    dish_id, submenu_id, menu_id = bench.created_dishes.pop()
+    return (await bench.request(
+        "DELETE", f"/menus/{menu_id}/submenus/{submenu_id}/dishes/{dish_id}"
+    ))[0]
+
+
+async def delete_submenu(bench: Benchmark) -> int:
+    if not bench.created_submenus:
+        await create_submenu(bench)
+    submenu_id, menu_id = bench.created_submenus.pop()
+    return (await bench.request("DELETE", f"/menus/{menu_id}/submenus/{submenu_id}"))[0]
+
+
+async def delete_menu(bench: Benchmark) -> int:
+    if not bench.created_menus:
+        await create_menu(bench)
+    return (await bench.request("DELETE", f"/menus/{bench.created_menus.pop()}"))[0]
+
+
+async def delete_menu_background(bench: Benchmark) -> int:
+    if not bench.created_menus:
+        await create_menu(bench)
+    status, body = await bench.request(
+        "DELETE", f"/menus/{bench.created_menus.pop()}?background=true"
+    )
+    if status == 202:
+        bench.jobs.append(int(json.loads(body)["job_id"]))
+    return status
+
+
+async def job_status(bench: Benchmark) -> int:
+    if not bench.jobs:
+        await delete_menu_background(bench)
+    return (await bench.request("GET", f"/admin/jobs/{bench.rng.choice(bench.jobs)}"))[0]
+
+
+async def export_catalog_table(bench: Benchmark) -> int:
+    return (await bench.request("GET", "/admin/catalog/submenu"))[0]
+
+
+async def import_catalog_table(bench: Benchmark) -> int:
+    return (await bench.request(
+        "POST", "/admin/catalog/menu", headers={"Content-Type": "text/csv"}, content=bench.menu_csv
+    ))[0]
+
+
+async def pool_stats(bench: Benchmark) -> int:
+    return (await bench.request("GET", "/service/pool"))[0]
+
+
+async def cache_stats(bench: Benchmark) -> int:
+    return (await bench.request("GET", "/service/cache"))[0]
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    scenario.__name__: scenario for scenario in [
+        menu_list,
+        menu_tree_list,
+        menu_detail,
+        menu_tree,
+        menu_stats,
+        submenu_list,
+        submenu_detail,
+        dish_list,
+        dish_stream,
+        dish_detail,
+        search_dishes,
+        create_menu,
+        create_submenu,
+        create_submenus_bulk,
+        create_dish,
+        create_dishes_bulk,
+        update_menu,
+        update_submenu,
+        update_dish,
+        update_dishes_bulk,
+        delete_dishes_bulk,
+        delete_dish,
+        delete_submenu,
+        delete_menu,
+        delete_menu_background,
+        job_status,
+        export_catalog_table,
+        import_catalog_table,
+        pool_stats,
+        cache_stats,
+    ]
+}
+
+
+def print_report(results: Dict[str, Dict[str, Any]]) -> None:
+    print(
+        f"{'scenario':<24}{'requests':>9}{'errors':>7}{'rps':>10}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'q/req':>7}{'rss mb':>8}"
+    )
+    for name, result in results.items():
+        print(
+            f"{name:<24}{result['requests']:>9}{result['errors']:>7}{result['rps']:>10.1f}"
+            f"{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}{result['p99_ms']:>9.2f}"
+            f"{result['queries_per_request']:>7.1f}{result['peak_rss_mb']:>8.1f}"
+        )
+
+
+def compare(
+    results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], threshold: float
+) -> List[str]:
+    """
+    Сравнение с сохранённым прогоном; регрессия - рост p95 или
+    падение rps больше чем на threshold
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        p95 = result["p95_ms"] / base["p95_ms"] - 1 if base["p95_ms"] else 0.0
+        rps = result["rps"] / base["rps"] - 1 if base["rps"] else 0.0
+        queries = result["queries_per_request"] - base["queries_per_request"]
+        mark = ""
+        if p95 > threshold or rps < -threshold or queries > 0.5:
+            mark = "REGRESSION"
+            regressions.append(name)
+        print(f"{name:<24}p95 {p95:+8.1%}  rps {rps:+8.1%}  q/req {queries:+5.1f}  {mark}")
+    return regressions
+
+
+async def main(args: argparse.Namespace) -> int:
+    try:
+        if args.seed:
+            started = time.perf_counter()
+            await seed_catalog(args.menus, args.submenus, args.dishes)
+            print(f"seeded in {time.perf_counter() - started:.1f}s")
+        if not args.cache:
+            response_cache.backend = CacheBackend()
+        bench = Benchmark(random.Random(args.random_seed), QueryCounter())
+        await bench.load_catalog()
+        names = args.scenarios or list(SCENARIOS)
+        results = {}
+        for name in names:
+            results[name] = await bench.run(SCENARIOS[name], args.requests, args.concurrency)
+        print_report(results)
+        report = {
+            "config": {
+                key: value for key, value in vars(args).items()
+                if key not in ("save", "compare")
+            },
+            "results": results,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        if args.save:
+            with open(args.save, "w") as file:
+                json.dump(report, file, indent=2)
+        if args.compare:
+            with open(args.compare, "r") as file:
+                baseline = json.load(file)
+            if compare(results, baseline["results"], args.threshold):
+                return 1
+        return 0
+    finally:
+        # Фоновые задачи удаления дорабатывают до закрытия пула
+        await asyncio.gather(*running, return_exceptions=True)
+        await db_engine_async.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон эндпоинтов через ASGI")
+    parser.add_argument("--seed", action="store_true", help="пересоздать синтетический каталог")
+    parser.add_argument("--menus", type=int, default=1000)
+    parser.add_argument("--submenus", type=int, default=10, help="подменю в меню")
+    parser.add_argument("--dishes", type=int, default=10, help="блюд в подменю")
+    parser.add_argument("--requests", type=int, default=500, help="запросов на сценарий")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS))
+    parser.add_argument("--no-cache", dest="cache", action="store_false")
+    parser.add_argument("--random-seed", type=int, default=0)
+    parser.add_argument("--save", help="файл для сохранения результатов")
+    parser.add_argument("--compare", help="файл с базовыми результатами")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    sys.exit(asyncio.run(main(parser.parse_args())))
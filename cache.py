@@ -0,0 +1,493 @@
+import asyncio
+import json
+import time
+import uuid
+from os import environ
+from collections import OrderedDict, defaultdict
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import Response, StreamingResponse
+
+from metrics import Gauge, registry
+from session import db_engine_async, db_route
+
+load_dotenv()
+
+# Ключи списков дополняются PAGE_KEY и сбрасываются по префиксу
+MENUS_KEY = "menus"
+MENUS_TREE_KEY = "tree"
+MENU_KEY = "menu:{menu_id}"
+MENU_TREE_KEY = "menu:{menu_id}:tree"
+MENU_STATS_KEY = "menu:{menu_id}:stats"
+SUBMENUS_KEY = "menu:{menu_id}:submenus"
+SUBMENU_KEY = "menu:{menu_id}:submenu:{submenu_id}"
+DISHES_KEY = "menu:{menu_id}:submenu:{submenu_id}:dishes"
+DISH_KEY = "menu:{menu_id}:submenu:{submenu_id}:dish:{dish_id}"
+PAGE_KEY = "?cursor={cursor}&limit={limit}"
+# Ключ записи дополняется версией данных, прочитанной etag_middleware:
+# ответ, загруженный до записи, не попадает под новую версию
+VERSION_KEY = "#{version}"
+cache_version: ContextVar[Optional[str]] = ContextVar("cache_version", default=None)
+# Версия, которую не удалось прочитать (база недоступна): отдаётся
+# последняя сохранённая запись ключа
+LAST_VERSION = "last"
+
+# Канал NOTIFY об изменённых меню; свои уведомления процесс пропускает
+INVALIDATION_CHANNEL = "catalog_invalidation"
+WORKER_ID = uuid.uuid4().hex
+# Больше меню в одном уведомлении - сбрасывается весь кеш
+# (payload NOTIFY ограничен 8000 байт)
+INVALIDATION_MAX_MENUS = 500
+
+# Запись кеша: значение и момент, после которого оно считается устаревшим
+Entry = Tuple[Any, float]
+
+
+def key_group(key: str) -> str:
+    """
+    Группа ключа или префикса для сброса: меню (menu:{menu_id})
+    либо список каталога (menus, tree)
+    """
+    head = key.split("?", 1)[0].split("#", 1)[0]
+    return ":".join(head.split(":", 2)[:2])
+
+
+class CacheBackend:
+    """
+    Хранилище кеша: записи живут ttl + stale_ttl секунд;
+    shared - хранилище общее для всех процессов
+    """
+    name = "none"
+    shared = False
+
+    async def get(self, key: str) -> Optional[Entry]:
+        return None
+
+    async def set(self, key: str, value: Any, expires_at: float, keep: float) -> None:
+        pass
+
+    async def delete(self, keys: Iterable[str], prefixes: Iterable[str]) -> None:
+        pass
+
+    def size(self) -> Optional[int]:
+        return None
+
+
+class MemoryCache(CacheBackend):
+    """
+    LRU-кеш в памяти процесса с ограничением размера; ключи
+    индексируются по группам, и сброс по префиксу просматривает
+    только ключи его группы
+    """
+    name = "memory"
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: "OrderedDict[str, Tuple[Any, float, float]]" = OrderedDict()
+        self.groups: Dict[str, Set[str]] = defaultdict(set)
+
+    def discard(self, key: str) -> None:
+        if self.entries.pop(key, None) is None:
+            return
+        group = key_group(key)
+        self.groups[group].discard(key)
+        if not self.groups[group]:
+            del self.groups[group]
+
+    async def get(self, key: str) -> Optional[Entry]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at, keep_until = entry
+        if keep_until <= time.time():
+            self.discard(key)
+            return None
+        self.entries.move_to_end(key)
+        return value, expires_at
+
+    async def set(self, key: str, value: Any, expires_at: float, keep: float) -> None:
+        self.entries[key] = (value, expires_at, expires_at + keep)
+        self.entries.move_to_end(key)
+        self.groups[key_group(key)].add(key)
+        while len(self.entries) > self.max_size:
+            self.discard(next(iter(self.entries)))
+
+    async def delete(self, keys: Iterable[str], prefixes: Iterable[str]) -> None:
+        """
+        Удаление ключей keys и ключей с префиксами prefixes; пустой
+        префикс очищает весь кеш
+        """
+        for key in keys:
+            self.discard(key)
+        groups: Dict[str, List[str]] = defaultdict(list)
+        for prefix in prefixes:
+            if not prefix:
+                self.entries.clear()
+                self.groups.clear()
+                return
+            groups[key_group(prefix)].append(prefix)
+        for group, group_prefixes in groups.items():
+            group_prefixes = tuple(group_prefixes)
+            for key in [key for key in self.groups.get(group, ()) if key.startswith(group_prefixes)]:
+                self.discard(key)
+
+    def size(self) -> Optional[int]:
+        return len(self.entries)
+
+
+class RedisCache(CacheBackend):
+    """
+    Кеш в любом сервере, говорящем на протоколе Redis
+    """
+    name = "redis"
+    shared = True
+
+    def __init__(self, url: str, namespace: str = "ylab:"):
+        from redis.asyncio import Redis
+
+        self.client = Redis.from_url(url)
+        self.namespace = namespace
+
+    async def get(self, key: str) -> Optional[Entry]:
+        raw = await self.client.get(self.namespace + key)
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        return entry["value"], entry["expires_at"]
+
+    async def set(self, key: str, value: Any, expires_at: float, keep: float) -> None:
+        ttl = max(expires_at + keep - time.time(), 0.001)
+        await self.client.set(
+            self.namespace + key,
+            json.dumps({"value": value, "expires_at": expires_at}),
+            px=int(ttl * 1000),
+        )
+
+    async def delete(self, keys: Iterable[str], prefixes: Iterable[str]) -> None:
+        """
+        Удаление только точных ключей, без SCAN по префиксам: версия меню
+        в ключе - счётчик поколений, после записи старые записи
+        недостижимы и истекают по TTL
+        """
+        names = [self.namespace + key for key in keys]
+        if names:
+            await self.client.delete(*names)
+
+
+class ResponseCache:
+    """
+    Кеш ответов GET-обработчиков с инвалидацией по иерархии
+    меню -> подменю -> блюдо; versions - последняя сохранённая
+    версия ключа (не больше max_versions ключей) для ответа, когда
+    версию прочитать не удалось
+    """
+
+    def __init__(
+        self, backend: CacheBackend, ttl: float, stale_ttl: float = 0, max_versions: int = 10000
+    ):
+        self.backend = backend
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_versions = max_versions
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.refreshing: Dict[str, asyncio.Task] = {}
+        self.versions: "OrderedDict[str, str]" = OrderedDict()
+
+    async def store(self, key: str, result: Any) -> None:
+        if isinstance(result, Response):
+            if result.status_code == 404:
+                await self.backend.delete([key], [])
+            if result.status_code != 200 or isinstance(result, StreamingResponse):
+                return
+            value = {
+                "body": result.body.decode(),
+                "headers": {
+                    name: value for name, value in result.headers.items()
+                    if name != "content-length"
+                },
+            }
+        else:
+            value = {"value": jsonable_encoder(result)}
+        await self.backend.set(key, value, time.time() + self.ttl, self.stale_ttl)
+        base, _, version = key.rpartition(VERSION_KEY.format(version=""))
+        self.versions[base] = version
+        self.versions.move_to_end(base)
+        while len(self.versions) > self.max_versions:
+            self.versions.popitem(last=False)
+
+    @staticmethod
+    def restore(value: Dict[str, Any]) -> Any:
+        if "value" in value:
+            return value["value"]
+        return Response(content=value["body"], headers=value["headers"])
+
+    @staticmethod
+    async def load(loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Загрузка значения для кеша из основной базы: реплика может
+        ещё не видеть запись, после которой кеш сброшен
+        """
+        token = db_route.set("primary")
+        try:
+            return await loader()
+        finally:
+            db_route.reset(token)
+
+    async def refresh(self, key: str, loader: Callable[[], Awaitable[Any]]) -> None:
+        try:
+            await self.store(key, await self.load(loader))
+        except Exception:
+            pass
+        finally:
+            self.refreshing.pop(key, None)
+
+    async def fetch(self, key: str, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Значение из кеша либо результат loader; устаревшее значение
+        отдаётся сразу, а обновляется в фоне
+        """
+        entry = await self.backend.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > time.time():
+                self.hits += 1
+                return self.restore(value)
+            self.stale += 1
+            if key not in self.refreshing:
+                self.refreshing[key] = asyncio.create_task(self.refresh(key, loader))
+            return self.restore(value)
+        self.misses += 1
+        result = await self.load(loader)
+        await self.store(key, result)
+        return result
+
+    async def fetch_last(self, key: str, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Последняя сохранённая запись ключа без версии, в том числе
+        устаревшая: база недоступна, и обновить её нельзя; без записи -
+        результат loader
+        """
+        version = self.versions.get(key)
+        entry = None
+        if version is not None:
+            entry = await self.backend.get(key + VERSION_KEY.format(version=version))
+        if entry is None:
+            return await loader()
+        self.stale += 1
+        return self.restore(entry[0])
+
+    def cached(self, key: str, bypass: Callable[[Dict[str, Any]], bool] = None):
+        """
+        Декоратор GET-обработчика; key - шаблон с параметрами пути,
+        bypass(kwargs) - признак запроса в обход кеша. Без версии
+        из cache_version запрос идёт в обход кеша, с LAST_VERSION
+        отдаётся последняя сохранённая запись
+        """
+        def decorator(handler):
+            @wraps(handler)
+            async def wrapper(**kwargs):
+                version = cache_version.get()
+                if version is None or (bypass is not None and bypass(kwargs)):
+                    return await handler(**kwargs)
+                if version == LAST_VERSION:
+                    return await self.fetch_last(key.format(**kwargs), lambda: handler(**kwargs))
+                return await self.fetch(
+                    key.format(**kwargs) + VERSION_KEY.format(version=version),
+                    lambda: handler(**kwargs),
+                )
+            return wrapper
+        return decorator
+
+    async def invalidate(self, *keys: str, lists: Iterable[str] = (), prefixes: Iterable[str] = ()) -> None:
+        """
+        Сброс записей всех версий ключей keys, страниц списков lists
+        и ключей с префиксами prefixes
+        """
+        await self.backend.delete(
+            [],
+            [key + "#" for key in keys] + [key + "?" for key in lists] + list(prefixes),
+        )
+
+    async def invalidate_all(self) -> None:
+        await self.invalidate(prefixes=[""])
+
+    async def invalidate_menu(self, menu_id: int, subtree: bool = False) -> None:
+        menu_key = MENU_KEY.format(menu_id=menu_id)
+        await self.invalidate(
+            menu_key,
+            MENU_TREE_KEY.format(menu_id=menu_id),
+            MENU_STATS_KEY.format(menu_id=menu_id),
+            lists=[MENUS_KEY, MENUS_TREE_KEY],
+            prefixes=[menu_key + ":"] if subtree else [],
+        )
+
+    async def invalidate_menus(self, menu_ids: Iterable[int]) -> None:
+        """
+        Сброс меню menu_ids со всеми потомками одним проходом;
+        0 - списки каталога
+        """
+        menu_keys = [MENU_KEY.format(menu_id=menu_id) for menu_id in menu_ids if menu_id]
+        await self.invalidate(
+            *menu_keys,
+            lists=[MENUS_KEY, MENUS_TREE_KEY],
+            prefixes=[menu_key + ":" for menu_key in menu_keys],
+        )
+
+    async def invalidate_submenu(
+        self, menu_id: int, submenu_id: int, subtree: bool = False
+    ) -> None:
+        submenu_key = SUBMENU_KEY.format(menu_id=menu_id, submenu_id=submenu_id)
+        await self.invalidate(
+            MENU_KEY.format(menu_id=menu_id),
+            MENU_TREE_KEY.format(menu_id=menu_id),
+            MENU_STATS_KEY.format(menu_id=menu_id),
+            submenu_key,
+            lists=[SUBMENUS_KEY.format(menu_id=menu_id), MENUS_TREE_KEY],
+            prefixes=[submenu_key + ":"] if subtree else [],
+        )
+
+    async def invalidate_dish(self, menu_id: int, submenu_id: int, dish_id: int) -> None:
+        await self.invalidate(
+            MENU_KEY.format(menu_id=menu_id),
+            MENU_TREE_KEY.format(menu_id=menu_id),
+            MENU_STATS_KEY.format(menu_id=menu_id),
+            SUBMENU_KEY.format(menu_id=menu_id, submenu_id=submenu_id),
+            DISH_KEY.format(menu_id=menu_id, submenu_id=submenu_id, dish_id=dish_id),
+            lists=[DISHES_KEY.format(menu_id=menu_id, submenu_id=submenu_id), MENUS_TREE_KEY],
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        requests = self.hits + self.misses + self.stale
+        return {
+            "backend": self.backend.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "hit_rate": (self.hits + self.stale) / requests if requests else 0.0,
+            "size": self.backend.size(),
+        }
+
+
+def invalidation_payload(menu_ids: List[int]) -> str:
+    """
+    Уведомление об изменении меню menu_ids (0 - списки каталога)
+    """
+    menus = list(menu_ids) if len(menu_ids) <= INVALIDATION_MAX_MENUS else None
+    return json.dumps({"worker": WORKER_ID, "menus": menus})
+
+
+class InvalidationListener:
+    """
+    Фоновое LISTEN в отдельном соединении: записи других процессов
+    сбрасывают кеш изменённых меню; после переподключения, когда
+    уведомления могли быть потеряны, сбрасывается весь кеш
+    """
+
+    def __init__(self, cache: ResponseCache, dsn: str, retry: float = 1):
+        self.cache = cache
+        self.dsn = dsn
+        self.retry = retry
+        self.received = 0
+        self.task: Optional[asyncio.Task] = None
+        self.pending: Set[asyncio.Task] = set()
+
+    async def apply(self, payload: str) -> None:
+        event = json.loads(payload)
+        if event["worker"] == WORKER_ID:
+            return
+        self.received += 1
+        if event["menus"] is None:
+            await self.cache.invalidate_all()
+            return
+        await self.cache.invalidate_menus(event["menus"])
+
+    def notify(self, connection, pid: int, channel: str, payload: str) -> None:
+        task = asyncio.create_task(self.apply(payload))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def listen(self) -> None:
+        import asyncpg
+
+        connected = False
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(self.dsn)
+                closed = asyncio.Event()
+                connection.add_termination_listener(lambda connection: closed.set())
+                await connection.add_listener(INVALIDATION_CHANNEL, self.notify)
+                if connected:
+                    await self.cache.invalidate_all()
+                connected = True
+                await closed.wait()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+            finally:
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(self.retry)
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.listen())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+def make_backend() -> CacheBackend:
+    backend = environ.get("CACHEBACKEND", "memory")
+    if backend == "memory":
+        return MemoryCache(max_size=int(environ.get("CACHESIZE", 10000)))
+    if backend == "redis":
+        return RedisCache(url=environ.get("CACHEURL", "redis://localhost:6379/0"))
+    return CacheBackend()
+
+
+response_cache = ResponseCache(
+    backend=make_backend(),
+    ttl=float(environ.get("CACHETTL", 60)),
+    stale_ttl=float(environ.get("CACHESTALETTL", 0)),
+    max_versions=int(environ.get("CACHESIZE", 10000)),
+)
+# Уведомления слушаются в основной базе: NOTIFY не доходит до реплик
+invalidation_listener = InvalidationListener(
+    response_cache,
+    dsn=db_engine_async.url.set(drivername="postgresql", query={}).render_as_string(
+        hide_password=False
+    ),
+)
+# Общее хранилище (redis) одно для всех процессов: записывающий процесс
+# сбрасывает его сам, а сброс по уведомлению лишь вытеснил бы свежие записи
+cache_notify = (
+    environ.get("CACHENOTIFY", "true").lower() == "true" and not response_cache.backend.shared
+)
+registry.register(Gauge(
+    "cache_requests_total",
+    "Response cache lookups by result",
+    lambda: {
+        (("result", "hit"),): response_cache.hits,
+        (("result", "miss"),): response_cache.misses,
+        (("result", "stale"),): response_cache.stale,
+    },
+    kind="counter",
+))
+registry.register(Gauge(
+    "cache_hit_ratio",
+    "Share of response cache lookups served from the cache",
+    lambda: {(): response_cache.stats()["hit_rate"]},
+))
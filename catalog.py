@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import os
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, List, Union
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from session import db_engine_async, get_async_session
+from utils import bump_versions, session_scope
+
+# Таблицы каталога в порядке загрузки: родители раньше потомков
+CATALOG_COLUMNS: Dict[str, List[str]] = {
+    "menu": ["id", "title", "description"],
+    "submenu": ["id", "title", "description", "menu_id"],
+    "dish": ["id", "title", "description", "price", "submenu_id"],
+}
+CATALOG_FORMATS = {"csv": "text/csv", "json": "application/x-ndjson"}
+# COPY в формате csv с символами, которых нет в JSON: строки идут как есть
+JSON_COPY_OPTIONS = {"format": "csv", "quote": "\x01", "delimiter": "\x02"}
+
+# Меню, затронутые загрузкой таблицы, для повышения их версий: новые
+# родители из загрузки и прежние родители обновляемых записей;
+# выполняется до вставки, пока видны прежние родители
+MENU_IDS_QUERY = {
+    "menu": "SELECT id FROM catalog_import",
+    "submenu": """
+        SELECT menu_id FROM catalog_import
+        UNION
+        SELECT s.menu_id
+        FROM catalog_import i
+        JOIN {schema}.submenu s ON s.id = i.id
+    """,
+    "dish": """
+        SELECT s.menu_id
+        FROM catalog_import i
+        JOIN {schema}.submenu s ON s.id = i.submenu_id
+        UNION
+        SELECT s.menu_id
+        FROM catalog_import i
+        JOIN {schema}.dish d ON d.id = i.id
+        JOIN {schema}.submenu s ON s.id = d.submenu_id
+    """,
+}
+# Блюда с неверной ценой, для ошибки загрузки
+INVALID_IDS_QUERY = {
+    "menu": None,
+    "submenu": None,
+    "dish": """
+        SELECT id FROM catalog_import
+        WHERE price IS NULL OR price <= 0
+        ORDER BY id
+        LIMIT 10
+    """,
+}
+# Подменю, затронутые загрузкой, для пересчёта статистики цен и фрагментов
+# дерева: сами подменю, для блюд - подменю до и после загрузки;
+# выполняется до вставки, пока видны прежние submenu_id
+SUBMENU_IDS_QUERY = {
+    "menu": None,
+    "submenu": "SELECT id FROM catalog_import",
+    "dish": """
+        SELECT submenu_id FROM catalog_import
+        UNION
+        SELECT d.submenu_id
+        FROM catalog_import i
+        JOIN {schema}.dish d ON d.id = i.id
+    """,
+}
+
+
+def lookup_query(table: str, schema: str) -> str:
+    """
+    Проверка загрузки и поиск затронутых меню и подменю одним запросом
+    """
+    arrays = [
+        f"ARRAY({queries[table]})" if queries[table] is not None else "CAST(ARRAY[] AS BIGINT[])"
+        for queries in (INVALID_IDS_QUERY, SUBMENU_IDS_QUERY, MENU_IDS_QUERY)
+    ]
+    return f"SELECT {', '.join(arrays)}".format(schema=schema)
+
+
+async def get_driver_connection(session: AsyncSession):
+    """
+    Соединение asyncpg из сессии, для COPY
+    """
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+    return raw_connection.driver_connection
+
+
+async def export_table(
+    table: str,
+    output: Callable[[bytes], Awaitable[None]],
+    fmt: str = "csv",
+    schema: str = "public",
+    session: AsyncSession = None,
+) -> None:
+    """
+    Выгрузка таблицы каталога через COPY ... TO STDOUT
+    """
+    columns = ", ".join(CATALOG_COLUMNS[table])
+    query = f"SELECT {columns} FROM {schema}.{table} ORDER BY id"
+    async with session_scope(session) as session:
+        driver = await get_driver_connection(session)
+        if fmt == "json":
+            await driver.copy_from_query(
+                f"SELECT row_to_json(catalog_row) FROM ({query}) catalog_row",
+                output=output,
+                **JSON_COPY_OPTIONS,
+            )
+        else:
+            await driver.copy_from_query(
+                query, output=output, format="csv", header=True
+            )
+
+
+async def export_stream(table: str, fmt: str = "csv") -> AsyncIterator[bytes]:
+    """
+    Выгрузка таблицы для потокового ответа: COPY пишет в очередь,
+    ответ читает из неё
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=16)
+
+    async def output(chunk: bytes) -> None:
+        await queue.put(bytes(chunk))
+
+    async def produce() -> None:
+        try:
+            await export_table(table, output=output, fmt=fmt)
+        finally:
+            await queue.put(None)
+
+    task = asyncio.create_task(produce())
+    try:
+        while (chunk := await queue.get()) is not None:
+            yield chunk
+        await task
+    finally:
+        task.cancel()
+
+
+async def import_table(
+    table: str,
+    source: Union[str, AsyncIterable[bytes]],
+    fmt: str = "csv",
+    schema: str = "public",
+    session: AsyncSession = None,
+) -> int:
+    """
+    Загрузка таблицы каталога через COPY ... FROM STDIN во временную
+    таблицу и вставку с обновлением по id; возвращает число строк
+    """
+    columns = CATALOG_COLUMNS[table]
+    column_line = ", ".join(columns)
+    async with session_scope(session) as session:
+        driver = await get_driver_connection(session)
+        if fmt == "json":
+            await session.execute(
+                text("CREATE TEMP TABLE catalog_import_json (doc jsonb) ON COMMIT DROP")
+            )
+            await driver.copy_to_table(
+                "catalog_import_json", source=source, **JSON_COPY_OPTIONS
+            )
+            # Таблица загрузки создаётся сразу из разобранных документов
+            await session.execute(
+                text(
+                    f"""
+                    CREATE TEMP TABLE catalog_import ON COMMIT DROP AS
+                    SELECT {column_line}
+                    FROM catalog_import_json,
+                    jsonb_populate_record(NULL::{schema}.{table}, doc)
+                    """
+                )
+            )
+        else:
+            await session.execute(
+                text(
+                    f"""
+                    CREATE TEMP TABLE catalog_import
+                    (LIKE {schema}.{table} INCLUDING DEFAULTS)
+                    ON COMMIT DROP
+                    """
+                )
+            )
+            await driver.copy_to_table(
+                "catalog_import",
+                source=source,
+                columns=columns,
+                format="csv",
+                header=True,
+            )
+        invalid_ids, submenu_ids, menu_ids = (await session.execute(
+            text(lookup_query(table, schema))
+        )).one()
+        if invalid_ids:
+            raise ValueError(f"price must be greater than 0, dish ids: {invalid_ids}")
+        update_line = ", ".join(
+            f"{column} = EXCLUDED.{column}" for column in columns if column != "id"
+        )
+        # Последовательность сдвигается тем же запросом; он ещё не видит
+        # вставленных строк в таблице, поэтому max(id) берётся и из RETURNING
+        rows = (await session.execute(
+            text(
+                f"""
+                WITH upserted AS (
+                    INSERT INTO {schema}.{table} ({column_line})
+                    SELECT {column_line} FROM catalog_import
+                    ON CONFLICT (id) DO UPDATE SET {update_line}
+                    RETURNING id
+                )
+                SELECT count(*), setval(
+                    pg_get_serial_sequence('{schema}.{table}', 'id'),
+                    GREATEST((SELECT max(id) FROM {schema}.{table}), max(id), 1)
+                )
+                FROM upserted
+                """
+            )
+        )).scalar()
+        await bump_versions(
+            menu_ids=menu_ids,
+            catalog=table == "menu",
+            submenu_ids=submenu_ids,
+            schema=schema,
+            session=session,
+        )
+        await session.execute(text("DROP TABLE IF EXISTS catalog_import, catalog_import_json"))
+        return rows
+
+
+async def export_catalog(directory: str, fmt: str = "csv") -> None:
+    """
+    Выгрузка всего каталога в файлы directory/<таблица>.<формат>
+    """
+    os.makedirs(directory, exist_ok=True)
+    async with get_async_session() as session:
+        for table in CATALOG_COLUMNS:
+            with open(os.path.join(directory, f"{table}.{fmt}"), "wb") as file:
+                async def output(chunk: bytes) -> None:
+                    file.write(chunk)
+                await export_table(table, output=output, fmt=fmt, session=session)
+
+
+async def import_catalog(directory: str, fmt: str = "csv") -> Dict[str, int]:
+    """
+    Загрузка всего каталога из directory в одной транзакции
+    """
+    rows = {}
+    async with get_async_session() as session:
+        for table in CATALOG_COLUMNS:
+            path = os.path.join(directory, f"{table}.{fmt}")
+            if os.path.exists(path):
+                rows[table] = await import_table(
+                    table, source=path, fmt=fmt, session=session
+                )
+    return rows
+
+
+async def main(command: str, directory: str, fmt: str) -> None:
+    try:
+        if command == "export":
+            await export_catalog(directory, fmt=fmt)
+        else:
+            print(await import_catalog(directory, fmt=fmt))
+    finally:
+        await db_engine_async.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Выгрузка и загрузка каталога через COPY")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("directory")
+    parser.add_argument("--format", choices=list(CATALOG_FORMATS), default="csv")
+    args = parser.parse_args()
+    asyncio.run(main(args.command, args.directory, args.format))
@@ -0,0 +1,13 @@
+import pytest
+from pytest_asyncio import is_async_test
+
+
+def pytest_collection_modifyitems(items):
+    """
+    Все асинхронные тесты выполняются в одном цикле событий,
+    иначе пул асинхронных соединений переживает свой цикл
+    """
+    session_scope_marker = pytest.mark.asyncio(scope="session")
+    for item in items:
+        if is_async_test(item):
+            item.add_marker(session_scope_marker, append=False)
@@ -0,0 +1,295 @@
+import asyncio
+import contextvars
+import logging
+from os import environ
+from typing import Any, Dict, Optional, Set
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import response_cache
+from session import get_async_session
+from utils import bump_versions, session_scope
+
+load_dotenv()
+
+# Строк, удаляемых одной транзакцией, и пауза между пачками в секундах
+delete_batch_size = int(environ.get("DELETEBATCHSIZE", 1000))
+delete_batch_pause = float(environ.get("DELETEBATCHPAUSE", 0))
+# Через сколько секунд без продвижения задача считается брошенной
+delete_job_stale = int(environ.get("DELETEJOBSTALE", 60))
+# Пауза между поисками брошенных задач в секундах
+delete_job_sweep = float(environ.get("DELETEJOBSWEEP", 10))
+# Попыток у упавшей задачи и пауза перед первым повтором в секундах;
+# каждая следующая пауза вдвое длиннее
+delete_job_attempts = int(environ.get("DELETEJOBATTEMPTS", 5))
+delete_job_retry = float(environ.get("DELETEJOBRETRY", 10))
+
+logger = logging.getLogger(__name__)
+
+# Пометка удаляемых строк и создание задачи одним запросом;
+# подменю удаляемого меню помечаются вместе с ним
+MARK_QUERY = {
+    "menu": """
+        WITH target AS (
+            UPDATE {schema}.menu SET deleting = true
+            WHERE id = :target_id AND NOT deleting
+            RETURNING id
+        ), submenus AS (
+            UPDATE {schema}.submenu SET deleting = true
+            WHERE menu_id IN (SELECT id FROM target)
+        )
+        INSERT INTO {schema}.delete_job (target, target_id, menu_id)
+        SELECT 'menu', id, id FROM target
+        RETURNING id
+    """,
+    "submenu": """
+        WITH target AS (
+            UPDATE {schema}.submenu SET deleting = true
+            WHERE id = :target_id AND menu_id = :menu_id AND NOT deleting
+            RETURNING id, menu_id
+        )
+        INSERT INTO {schema}.delete_job (target, target_id, menu_id)
+        SELECT 'submenu', id, menu_id FROM target
+        RETURNING id
+    """,
+}
+# Повторный запуск упавшей задачи при повторном запросе удаления
+RETRY_QUERY = """
+    UPDATE {schema}.delete_job
+    SET status = 'pending', attempts = 0, error = NULL, updated_at = now()
+    WHERE id IN (
+        SELECT id FROM {schema}.delete_job
+        WHERE target = :target AND target_id = :target_id
+        AND menu_id = :menu_id AND status = 'failed'
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id
+"""
+# Пачки потомков, затем сама строка; каскад остаётся без работы
+BATCH_QUERIES = {
+    "menu": [
+        """
+        DELETE FROM {schema}.dish WHERE id IN (
+            SELECT d.id FROM {schema}.dish d
+            JOIN {schema}.submenu s ON s.id = d.submenu_id
+            WHERE s.menu_id = :target_id
+            LIMIT :batch_size
+        )
+        """,
+        """
+        DELETE FROM {schema}.submenu WHERE id IN (
+            SELECT id FROM {schema}.submenu WHERE menu_id = :target_id LIMIT :batch_size
+        )
+        """,
+        "DELETE FROM {schema}.menu WHERE id = :target_id",
+    ],
+    "submenu": [
+        """
+        DELETE FROM {schema}.dish WHERE id IN (
+            SELECT id FROM {schema}.dish WHERE submenu_id = :target_id LIMIT :batch_size
+        )
+        """,
+        "DELETE FROM {schema}.submenu WHERE id = :target_id",
+    ],
+}
+
+# Задачи этого процесса, чтобы их не собрал сборщик мусора,
+# и id выполняемых им задач удаления
+running: Set[asyncio.Task] = set()
+active_jobs: Set[int] = set()
+
+
+async def create_delete_job(
+    target: str,
+    target_id: int,
+    menu_id: int,
+    schema: str = "public",
+    session: AsyncSession = None,
+) -> Optional[int]:
+    """
+    Пометка меню или подменю как удаляемого и создание задачи;
+    для уже помеченной строки - повтор её упавшей задачи;
+    None, если строки нет или её задача ещё выполняется
+    """
+    async with session_scope(session) as session:
+        job_id = (await session.execute(
+            text(MARK_QUERY[target].format(schema=schema)),
+            {"target_id": target_id, "menu_id": menu_id},
+        )).scalar()
+        if job_id is None:
+            return (await session.execute(
+                text(RETRY_QUERY.format(schema=schema)),
+                {"target": target, "target_id": target_id, "menu_id": menu_id},
+            )).scalar()
+        if job_id is not None:
+            await bump_versions(
+                menu_id=menu_id,
+                catalog=target == "menu",
+                submenu_ids=[target_id] if target == "submenu" else (),
+                schema=schema,
+                session=session,
+            )
+        return job_id
+
+
+async def get_job(job_id: int, schema: str = "public") -> Optional[Dict[str, Any]]:
+    async with get_async_session() as session:
+        job = (await session.execute(
+            text(
+                f"""
+                SELECT id, target, target_id, menu_id, status, deleted, attempts, error
+                FROM {schema}.delete_job
+                WHERE id = :job_id
+                """
+            ),
+            {"job_id": job_id},
+        )).mappings().first()
+    return dict(job) if job is not None else None
+
+
+async def set_job(job_id: int, schema: str = "public", **values: Any) -> None:
+    set_line = ", ".join(f"{column} = :{column}" for column in values)
+    async with get_async_session() as session:
+        await session.execute(
+            text(
+                f"""
+                UPDATE {schema}.delete_job
+                SET {set_line}, updated_at = now()
+                WHERE id = :job_id
+                """
+            ),
+            values | {"job_id": job_id},
+        )
+
+
+async def run_delete_job(job_id: int, schema: str = "public") -> None:
+    """
+    Удаление потомков пачками по delete_batch_size строк, каждая
+    в своей транзакции, затем удаление самой строки
+    """
+    job = await get_job(job_id, schema=schema)
+    if job is None or job["status"] == "done":
+        return
+    await set_job(job_id, schema=schema, status="running")
+    deleted = job["deleted"]
+    try:
+        for query in BATCH_QUERIES[job["target"]]:
+            while True:
+                async with get_async_session() as session:
+                    rows = await session.execute(
+                        text(query.format(schema=schema)),
+                        {"target_id": job["target_id"], "batch_size": delete_batch_size},
+                    )
+                    deleted += rows.rowcount
+                    await session.execute(
+                        text(
+                            f"""
+                            UPDATE {schema}.delete_job
+                            SET deleted = :deleted, updated_at = now()
+                            WHERE id = :job_id
+                            """
+                        ),
+                        {"deleted": deleted, "job_id": job_id},
+                    )
+                if rows.rowcount < delete_batch_size:
+                    break
+                await asyncio.sleep(delete_batch_pause)
+        await bump_versions(menu_id=job["menu_id"], schema=schema)
+        await set_job(job_id, schema=schema, status="done")
+    except Exception as exception:
+        await set_job(
+            job_id,
+            schema=schema,
+            status="failed",
+            attempts=job["attempts"] + 1,
+            error=str(exception),
+        )
+    if job["target"] == "menu":
+        await response_cache.invalidate_menu(job["menu_id"], subtree=True)
+    else:
+        await response_cache.invalidate_submenu(job["menu_id"], job["target_id"], subtree=True)
+
+
+def start_task(coroutine) -> None:
+    """
+    Запуск фоновой задачи вне контекста запроса: её запросы идут
+    в основную базу и не учитываются в метриках запроса
+    """
+    task = asyncio.create_task(coroutine, context=contextvars.Context())
+    running.add(task)
+    task.add_done_callback(running.discard)
+
+
+def start_job(job_id: int) -> None:
+    active_jobs.add(job_id)
+
+    async def run() -> None:
+        try:
+            await run_delete_job(job_id)
+        finally:
+            active_jobs.discard(job_id)
+
+    start_task(run())
+
+
+async def resume_jobs(schema: str = "public") -> None:
+    """
+    Запуск задач, брошенных остановленным процессом, и повтор упавших
+    с растущей паузой; задача забирается одним процессом через
+    FOR UPDATE SKIP LOCKED
+    """
+    async with get_async_session() as session:
+        job_ids = (await session.execute(
+            text(
+                f"""
+                UPDATE {schema}.delete_job SET status = 'running', updated_at = now()
+                WHERE id IN (
+                    SELECT id FROM {schema}.delete_job
+                    WHERE (
+                        status IN ('pending', 'running')
+                        AND updated_at < now() - make_interval(secs => :stale)
+                        OR status = 'failed' AND attempts < :attempts
+                        AND updated_at < now() - make_interval(
+                            secs => :retry * power(2, attempts - 1)
+                        )
+                    )
+                    AND id <> ALL(:active)
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id
+                """
+            ),
+            {
+                "stale": float(delete_job_stale),
+                "attempts": delete_job_attempts,
+                "retry": delete_job_retry,
+                "active": list(active_jobs),
+            },
+        )).scalars().all()
+    for job_id in job_ids:
+        start_job(job_id)
+
+
+async def sweep_jobs(schema: str = "public") -> None:
+    """
+    Поиск брошенных задач при запуске и затем каждые delete_job_sweep
+    секунд; недоступная база не останавливает поиск
+    """
+    while True:
+        try:
+            await resume_jobs(schema=schema)
+        except Exception as exception:
+            logger.warning("delete job sweep failed: %s", exception)
+        await asyncio.sleep(delete_job_sweep)
+
+
+def start_sweeper() -> None:
+    start_task(sweep_jobs())
+
+
+async def stop_jobs() -> None:
+    for task in list(running):
+        task.cancel()
+    await asyncio.gather(*running, return_exceptions=True)
@@ -1,6 +1,210 @@
-from fastapi import FastAPI
+import time
+
+# Начало импорта приложения - отсчёт времени запуска для /ready
+import_started = time.perf_counter()
+
+import asyncio
+import logging
+import re
+from contextlib import asynccontextmanager
+from os import environ
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Match
 
 from api import menu_v1_router
+from cache import LAST_VERSION, cache_notify, cache_version, invalidation_listener
+from jobs import start_sweeper, stop_jobs
+from metrics import (
+    RequestStats,
+    http_db_time,
+    http_latency,
+    http_queries,
+    http_requests,
+    query_budget_exceeded,
+    registry,
+    request_stats,
+)
+from session import (
+    READ_YOUR_WRITES_COOKIE,
+    db_read_your_writes,
+    db_route,
+    page_limit,
+    path_prefix,
+)
+from utils import get_tree_version, get_version, wants_ndjson
+from warmup import WarmUp
+
+warm_up = WarmUp(import_started)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Фоновые задачи процесса: прогрев, слушатель сброса кеша и поиск
+    брошенных задач удаления; запросы принимаются сразу, /ready - после
+    прогрева
+    """
+    warm_up_task = asyncio.create_task(warm_up.run(app))
+    if cache_notify:
+        invalidation_listener.start()
+    start_sweeper()
+    yield
+    warm_up_task.cancel()
+    await asyncio.gather(warm_up_task, return_exceptions=True)
+    await stop_jobs()
+    await invalidation_listener.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+app.include_router(menu_v1_router)
+
+logger = logging.getLogger(__name__)
+# Запись в журнал запросов сверх бюджета маршрута
+query_budget_log = environ.get("QUERYBUDGETLOG", "false").lower() == "true"
+
+# /menus - версия каталога, /menus/tree - версия страницы, /menus/{menu_id}/... - версия меню
+menu_path = re.compile(rf"^{path_prefix}/menus(?:/(\d+))?(?:/|$)")
+tree_path = f"{path_prefix}/menus/tree"
+
+
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    """
+    Слабое сравнение ETag со списком из If-None-Match
+    """
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+@app.middleware("http")
+async def etag_middleware(request: Request, call_next):
+    """
+    ETag для GET-запросов каталога по версии меню; совпавший
+    If-None-Match получает 304 без выполнения обработчика.
+    Та же версия входит в ключ кеша ответа; если версию прочитать
+    не удалось, кеш отдаёт последнюю сохранённую запись
+    """
+    match = menu_path.match(request.url.path) if request.method == "GET" else None
+    if match is None:
+        return await call_next(request)
+    menu_id = match.group(1)
+    try:
+        if request.url.path == tree_path:
+            # Страница дерева зависит от своих меню, а не от всего каталога
+            params = request.query_params
+            version = await get_tree_version(
+                cursor=int(params.get("cursor") or 0),
+                limit=int(params.get("limit") or page_limit),
+            )
+            menu_id = "tree"
+        else:
+            version = await get_version(menu_id=int(menu_id) if menu_id else None)
+    except Exception:
+        # База недоступна: без ETag, из кеша - последняя сохранённая запись
+        token = cache_version.set(LAST_VERSION)
+        try:
+            return await call_next(request)
+        finally:
+            cache_version.reset(token)
+    variant = "-ndjson" if wants_ndjson(request.headers.get("accept")) else ""
+    etag = f'W/"{menu_id or "catalog"}-{version}{variant}"'
+    headers = {"ETag": etag, "Vary": "Accept"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+    token = cache_version.set(str(version))
+    try:
+        response = await call_next(request)
+    finally:
+        cache_version.reset(token)
+    if response.status_code == 200:
+        response.headers.update(headers)
+    return response
+
+
+def request_route(request: Request):
+    """
+    Маршрут запроса для меток метрик; запросы без маршрута
+    (304 из etag_middleware, 404) сопоставляются заново
+    """
+    route = request.scope.get("route")
+    if route is None:
+        for candidate in app.router.routes:
+            match, _ = candidate.matches(request.scope)
+            if match == Match.FULL:
+                return candidate
+    return route
+
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    """
+    Время ответа, число и время запросов к базе по маршрутам;
+    X-Query-Count и X-Query-Budget - число запросов и бюджет маршрута
+    (для потоковых ответов без запросов при выдаче тела)
+    """
+    stats = RequestStats()
+    token = request_stats.set(stats)
+    started = time.perf_counter()
+    status = 500
+    route = None
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        route = request_route(request)
+        response.headers["X-Query-Count"] = str(stats.queries)
+        budget = getattr(getattr(route, "endpoint", None), "query_budget", None)
+        if budget is not None:
+            response.headers["X-Query-Budget"] = str(budget)
+            if stats.queries > budget:
+                query_budget_exceeded.inc(route=route.path)
+                if query_budget_log:
+                    logger.warning(
+                        "%s %s: %d queries over budget %d",
+                        request.method, route.path, stats.queries, budget,
+                    )
+        return response
+    finally:
+        request_stats.reset(token)
+        route = getattr(route or request_route(request), "path", "unmatched")
+        http_requests.inc(route=route, method=request.method, status=str(status))
+        http_latency.observe(time.perf_counter() - started, route=route)
+        http_queries.observe(stats.queries, route=route)
+        http_db_time.observe(stats.db_time, route=route)
+
+
+@app.middleware("http")
+async def routing_middleware(request: Request, call_next):
+    """
+    Чтения GET-запросов - в реплики; после успешной записи клиент
+    db_read_your_writes секунд читает из основной базы
+    """
+    read_only = request.method in ("GET", "HEAD")
+    replica = read_only and READ_YOUR_WRITES_COOKIE not in request.cookies
+    token = db_route.set("replica" if replica else "primary")
+    try:
+        response = await call_next(request)
+    finally:
+        db_route.reset(token)
+    if not read_only and response.status_code < 400 and db_read_your_writes > 0:
+        response.set_cookie(
+            READ_YOUR_WRITES_COOKIE, "1", max_age=db_read_your_writes, httponly=True
+        )
+    return response
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics() -> PlainTextResponse:
+    """
+    Метрики в текстовом формате Prometheus
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 
-app = FastAPI()
-app.include_router(menu_v1_router)
\ No newline at end of file
+@app.get("/ready", include_in_schema=False)
+async def ready() -> JSONResponse:
+    """
+    Готовность процесса: 503 до успешного прогрева, затем 200
+    со временем запуска по этапам
+    """
+    return JSONResponse(warm_up.status(), status_code=200 if warm_up.ready else 503)
@@ -0,0 +1,175 @@
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Границы корзин гистограмм в секундах и для числа запросов
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def label_line(labels: Labels) -> str:
+    if not labels:
+        return ""
+    values = ",".join(
+        '{}="{}"'.format(name, value.replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + values + "}"
+
+
+class Counter:
+    """
+    Счётчик Prometheus с метками
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.values.items():
+            yield f"{self.name}{label_line(labels)} {value}"
+
+
+class Histogram:
+    """
+    Гистограмма Prometheus с метками: накопленные корзины, сумма и число
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.values: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        counts = self.values.get(key)
+        if counts is None:
+            # Корзины, затем +Inf, сумма
+            counts = self.values[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self) -> Iterable[str]:
+        for labels, counts in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                yield f"{self.name}_bucket{label_line(labels + (('le', str(bound)),))} {total}"
+            yield f"{self.name}_sum{label_line(labels)} {counts[-1]}"
+            yield f"{self.name}_count{label_line(labels)} {total}"
+
+
+class Gauge:
+    """
+    Значение, снимаемое в момент выдачи метрик; kind="counter" -
+    для счётчиков, которые ведутся вне реестра
+    """
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        collect: Callable[[], Dict[Labels, float]],
+        kind: str = "gauge",
+    ):
+        self.name = name
+        self.description = description
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.collect().items():
+            yield f"{self.name}{label_line(labels)} {value}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Текстовый формат Prometheus
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+class RequestStats:
+    """
+    Запросы к базе в рамках одного HTTP-запроса
+    """
+    __slots__ = ("queries", "db_time")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+registry = Registry()
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+http_requests = registry.register(Counter(
+    "http_requests_total", "HTTP requests by route, method and status"
+))
+http_latency = registry.register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route"
+))
+http_queries = registry.register(Histogram(
+    "http_request_queries", "Database queries per HTTP request by route", QUERY_BUCKETS
+))
+http_db_time = registry.register(Histogram(
+    "http_request_db_seconds", "Database time per HTTP request by route"
+))
+db_queries = registry.register(Histogram(
+    "db_query_duration_seconds", "Database query latency by engine"
+))
+db_pool_wait = registry.register(Histogram(
+    "db_pool_checkout_seconds", "Time to check a connection out of the pool by engine"
+))
+query_budget_exceeded = registry.register(Counter(
+    "http_query_budget_exceeded_total", "HTTP requests over the query budget of their route"
+))
+
+
+def query_budget(max_queries: int):
+    """
+    Декоратор обработчика: наибольшее число запросов к базе на один
+    HTTP-запрос, включая проверку версии в etag_middleware; ставится
+    под декораторами маршрута и кеша
+    """
+    def decorator(handler):
+        handler.query_budget = max_queries
+        return handler
+    return decorator
+
+
+def observe_query(engine: str, started: float) -> None:
+    """
+    Учёт выполненного запроса к базе: общий и в текущем HTTP-запросе
+    """
+    duration = time.perf_counter() - started
+    db_queries.observe(duration, engine=engine)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += duration
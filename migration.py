@@ -1,13 +1,127 @@
+import os
+import re
+from typing import List, Optional, Tuple
+
 from sqlalchemy import text
 from sqlalchemy_utils import create_database, database_exists
 
-from session import db_url, get_session
+from session import db_engine_sync, db_url
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+# Файлы вида 0001_name.sql, номер - версия миграции
+MIGRATION_FILE = re.compile(r"^(\d+)_\w+\.sql$")
+# Первая строка файла, например для CREATE INDEX CONCURRENTLY
+NO_TRANSACTION = "-- no-transaction"
+# Индекс, который строится вне транзакции; неудачная сборка оставляет
+# INVALID-индекс, который IF NOT EXISTS молча пропускает
+CONCURRENT_INDEX = re.compile(
+    r'^CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)\s+ON\s+(?:"?(\w+)"?\.)?',
+    re.IGNORECASE | re.MULTILINE,
+)
+# Ключ advisory-блокировки: одновременно миграции выполняет один процесс
+MIGRATION_LOCK = 7_260_013
+
+
+def get_migrations() -> List[Tuple[int, str]]:
+    """
+    Список миграций (версия, файл) по возрастанию версии
+    """
+    migrations = []
+    for name in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE.match(name)
+        if match:
+            migrations.append((int(match.group(1)), name))
+    return sorted(migrations)
+
+
+def split_statements(query: str) -> List[str]:
+    """
+    Разбиение файла на команды по ; в конце строки
+    """
+    statements = re.split(r";\s*$", query, flags=re.MULTILINE)
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+def index_valid(connection, index: str) -> Optional[bool]:
+    """
+    Признак готовности индекса; None, если индекса нет
+    """
+    return connection.execute(
+        text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:index)"),
+        {"index": index},
+    ).scalar()
+
+
+def run_statement(connection, statement: str) -> None:
+    """
+    Команда миграции без транзакции; INVALID-индекс от прошлой неудачной
+    сборки удаляется перед повтором, а неготовый после сборки - ошибка
+    """
+    match = CONCURRENT_INDEX.search(statement)
+    if match is None:
+        connection.exec_driver_sql(statement)
+        return
+    index = f'"{match.group(2) or "public"}".{match.group(1)}'
+    if index_valid(connection, index) is False:
+        connection.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {index}")
+    connection.exec_driver_sql(statement)
+    if not index_valid(connection, index):
+        raise RuntimeError(f"index {index} is not valid after build")
+
+
+def migrate() -> List[str]:
+    """
+    Применение ещё не выполненных миграций; каждая миграция и запись
+    её версии идут в одной транзакции
+    """
+    if not database_exists(db_url):
+        create_database(db_url)
+    applied = []
+    with db_engine_sync.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        connection.execute(text("SELECT pg_advisory_lock(:lock)"), {"lock": MIGRATION_LOCK})
+        try:
+            connection.execute(
+                text(
+                    """
+                    CREATE TABLE IF NOT EXISTS "public".schema_migration (
+                        version INTEGER NOT NULL,
+                        name VARCHAR(256) NOT NULL,
+                        applied_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                        PRIMARY KEY (version)
+                    )
+                    """
+                )
+            )
+            versions = set(
+                connection.execute(
+                    text('SELECT version FROM "public".schema_migration')
+                ).scalars()
+            )
+            for version, name in get_migrations():
+                if version in versions:
+                    continue
+                with open(os.path.join(MIGRATIONS_DIR, name), "r") as file:
+                    query = file.read()
+                record = text(
+                    'INSERT INTO "public".schema_migration (version, name) VALUES (:version, :name)'
+                )
+                if query.startswith(NO_TRANSACTION):
+                    # Команды идут по одной вне транзакции, поэтому должны
+                    # быть идемпотентными (IF NOT EXISTS)
+                    for statement in split_statements(query):
+                        run_statement(connection, statement)
+                    connection.execute(record, {"version": version, "name": name})
+                else:
+                    with db_engine_sync.begin() as transaction:
+                        transaction.exec_driver_sql(query)
+                        transaction.execute(record, {"version": version, "name": name})
+                applied.append(name)
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:lock)"), {"lock": MIGRATION_LOCK})
+    return applied
 
-if not database_exists(db_url):
-    create_database(db_url)
 
-with open("init.sql", "r") as file:
-    query = file.read()
-    with get_session() as session:
-        session.execute(text(query))
-        session.commit()
\ No newline at end of file
+if __name__ == "__main__":
+    for name in migrate():
+        print(f"applied {name}")
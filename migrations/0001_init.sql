@@ -1,11 +1,11 @@
-CREATE TABLE "public".menu (
+CREATE TABLE IF NOT EXISTS "public".menu (
     id SERIAL NOT NULL,
     title VARCHAR(256) NOT NULL,
     description VARCHAR(1024) NOT NULL,
     PRIMARY KEY (id)
 );
 
-CREATE TABLE "public".submenu (
+CREATE TABLE IF NOT EXISTS "public".submenu (
     id SERIAL NOT NULL,
     title VARCHAR(256) NOT NULL,
     description VARCHAR(1024) NOT NULL,
@@ -13,7 +13,7 @@ CREATE TABLE "public".submenu (
     PRIMARY KEY (id)
 );
 
-CREATE TABLE "public".dish (
+CREATE TABLE IF NOT EXISTS "public".dish (
     id SERIAL NOT NULL,
     title VARCHAR(256) NOT NULL,
     description VARCHAR(1024) NOT NULL,
@@ -21,4 +21,10 @@ CREATE TABLE "public".dish (
     CHECK (price > 0),
     submenu_id BIGINT NOT NULL REFERENCES "public".submenu (id) ON DELETE CASCADE,
     PRIMARY KEY (id)
-);
\ No newline at end of file
+);
+
+CREATE TABLE IF NOT EXISTS "public".menu_version (
+    menu_id BIGINT NOT NULL,
+    version BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (menu_id)
+);
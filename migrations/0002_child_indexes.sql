@@ -0,0 +1,4 @@
+-- no-transaction
+CREATE INDEX CONCURRENTLY IF NOT EXISTS submenu_menu_id_idx ON "public".submenu (menu_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS dish_submenu_id_idx ON "public".dish (submenu_id);
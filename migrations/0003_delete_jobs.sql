@@ -0,0 +1,18 @@
+ALTER TABLE "public".menu ADD COLUMN IF NOT EXISTS deleting BOOLEAN NOT NULL DEFAULT false;
+
+ALTER TABLE "public".submenu ADD COLUMN IF NOT EXISTS deleting BOOLEAN NOT NULL DEFAULT false;
+
+CREATE TABLE IF NOT EXISTS "public".delete_job (
+    id SERIAL NOT NULL,
+    target VARCHAR(16) NOT NULL,
+    target_id BIGINT NOT NULL,
+    menu_id BIGINT NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    deleted BIGINT NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (id)
+);
+
+CREATE INDEX IF NOT EXISTS delete_job_status_idx ON "public".delete_job (status) WHERE status IN ('pending', 'running');
@@ -0,0 +1,8 @@
+-- no-transaction
+CREATE INDEX CONCURRENTLY IF NOT EXISTS dish_search_idx ON "public".dish USING GIN (
+    (setweight(to_tsvector('simple', title), 'A') || setweight(to_tsvector('simple', description), 'B'))
+);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS submenu_search_idx ON "public".submenu USING GIN (
+    (to_tsvector('simple', title))
+);
@@ -0,0 +1,15 @@
+CREATE TABLE IF NOT EXISTS "public".submenu_price_stats (
+    submenu_id BIGINT NOT NULL REFERENCES "public".submenu (id) ON DELETE CASCADE,
+    dishes_count BIGINT NOT NULL DEFAULT 0,
+    price_min NUMERIC(10, 3),
+    price_max NUMERIC(10, 3),
+    price_sum NUMERIC NOT NULL DEFAULT 0,
+    PRIMARY KEY (submenu_id)
+);
+
+INSERT INTO "public".submenu_price_stats (submenu_id, dishes_count, price_min, price_max, price_sum)
+SELECT s.id, count(d.id), min(d.price), max(d.price), coalesce(sum(d.price), 0)
+FROM "public".submenu s
+LEFT JOIN "public".dish d ON d.submenu_id = s.id
+GROUP BY s.id
+ON CONFLICT (submenu_id) DO NOTHING;
@@ -0,0 +1,65 @@
+CREATE TABLE IF NOT EXISTS "public".menu_document (
+    menu_id BIGINT NOT NULL REFERENCES "public".menu (id) ON DELETE CASCADE,
+    detail BYTEA NOT NULL,
+    tree BYTEA NOT NULL,
+    PRIMARY KEY (menu_id)
+);
+
+WITH submenus AS (
+    SELECT s.menu_id, s.id, s.title, s.description,
+           count(d.id) AS dishes_count,
+           coalesce(
+               json_agg(
+                   json_build_object(
+                       'id', CAST(d.id AS TEXT),
+                       'title', d.title,
+                       'description', d.description,
+                       'price', to_char(d.price, 'FM999999990.00')
+                   ) ORDER BY d.id
+               ) FILTER (WHERE d.id IS NOT NULL),
+               '[]'
+           ) AS dishes
+    FROM "public".submenu s
+    LEFT JOIN "public".dish d ON d.submenu_id = s.id
+    WHERE NOT s.deleting
+    GROUP BY s.id
+), menus AS (
+    SELECT m.id, m.title, m.description,
+           count(s.id) AS submenus_count,
+           coalesce(sum(s.dishes_count), 0) AS dishes_count,
+           coalesce(
+               json_agg(
+                   json_build_object(
+                       'id', CAST(s.id AS TEXT),
+                       'title', s.title,
+                       'description', s.description,
+                       'dishes_count', s.dishes_count,
+                       'dishes', s.dishes
+                   ) ORDER BY s.id
+               ) FILTER (WHERE s.id IS NOT NULL),
+               '[]'
+           ) AS submenus
+    FROM "public".menu m
+    LEFT JOIN submenus s ON s.menu_id = m.id
+    WHERE NOT m.deleting
+    GROUP BY m.id
+)
+INSERT INTO "public".menu_document (menu_id, detail, tree)
+SELECT id,
+       convert_to(CAST(json_build_object(
+           'id', CAST(id AS TEXT),
+           'title', title,
+           'description', description,
+           'submenus_count', submenus_count,
+           'dishes_count', dishes_count
+       ) AS TEXT), 'UTF8'),
+       convert_to(CAST(json_build_object(
+           'id', CAST(id AS TEXT),
+           'title', title,
+           'description', description,
+           'submenus_count', submenus_count,
+           'dishes_count', dishes_count,
+           'submenus', submenus
+       ) AS TEXT), 'UTF8')
+FROM menus
+ON CONFLICT (menu_id) DO NOTHING;
@@ -0,0 +1,37 @@
+CREATE TABLE IF NOT EXISTS "public".submenu_document (
+    submenu_id BIGINT NOT NULL REFERENCES "public".submenu (id) ON DELETE CASCADE,
+    menu_id BIGINT NOT NULL,
+    dishes_count BIGINT NOT NULL,
+    fragment BYTEA NOT NULL,
+    PRIMARY KEY (submenu_id)
+);
+
+CREATE INDEX IF NOT EXISTS submenu_document_menu_id_idx
+ON "public".submenu_document (menu_id, submenu_id);
+
+INSERT INTO "public".submenu_document (submenu_id, menu_id, dishes_count, fragment)
+SELECT s.id, s.menu_id, count(d.id),
+       convert_to(CAST(json_build_object(
+           'id', CAST(s.id AS TEXT),
+           'title', s.title,
+           'description', s.description,
+           'dishes_count', count(d.id),
+           'dishes', coalesce(
+               json_agg(
+                   json_build_object(
+                       'id', CAST(d.id AS TEXT),
+                       'title', d.title,
+                       'description', d.description,
+                       'price', to_char(d.price, 'FM999999990.00')
+                   ) ORDER BY d.id
+               ) FILTER (WHERE d.id IS NOT NULL),
+               '[]'
+           )
+       ) AS TEXT), 'UTF8')
+FROM "public".submenu s
+LEFT JOIN "public".dish d ON d.submenu_id = s.id
+WHERE NOT s.deleting
+GROUP BY s.id
+ON CONFLICT (submenu_id) DO NOTHING;
+
+ALTER TABLE "public".menu_document DROP COLUMN IF EXISTS tree;
@@ -0,0 +1,5 @@
+ALTER TABLE "public".delete_job ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+
+DROP INDEX IF EXISTS "public".delete_job_status_idx;
+
+CREATE INDEX IF NOT EXISTS delete_job_status_idx ON "public".delete_job (status) WHERE status IN ('pending', 'running', 'failed');
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, BigInteger, Float, ForeignKey
+from sqlalchemy import Column, Integer, String, BigInteger, Boolean, Float, ForeignKey, false
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -9,6 +9,7 @@ class MenuPy(Base):
     id = Column(Integer, nullable=False, primary_key=True)
     title = Column(String(256), nullable=False)
     description = Column(String(1024), nullable=False)
+    deleting = Column(Boolean, nullable=False, server_default=false())
 
 
 class SubmenuPy(Base):
@@ -18,6 +19,7 @@ class SubmenuPy(Base):
     title = Column(String(256), nullable=False)
     description = Column(String(1024), nullable=False)
     menu_id = Column(BigInteger, ForeignKey("Menu.id", ondelete="CASCADE"), nullable=False)
+    deleting = Column(Boolean, nullable=False, server_default=false())
 
 
 class DishPy(Base):
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Union
+from typing import List, Optional, Union
 
 
 class MainFieldsPy(BaseModel):
@@ -31,4 +31,51 @@ class MainDishPy(MainFieldsPy):
 
 class GetDishPy(MainDishPy):
     id: Union[int, str]
-    submenu_id: Union[int, str]
\ No newline at end of file
+    submenu_id: Union[int, str]
+
+
+class SearchDishPy(GetDishPy):
+    menu_id: Union[int, str]
+    submenu_title: str
+    rank: float
+
+
+class DishPricePy(BaseModel):
+    id: int
+    price: Union[str, float]
+
+
+class BulkDishUpdatePy(BaseModel):
+    prices: List[DishPricePy] = []
+    percent: Optional[float] = None
+    ids: List[int] = []
+
+
+class BulkSubmenuPy(MainFieldsPy):
+    dishes: List[MainDishPy] = []
+
+
+class PriceStatsPy(BaseModel):
+    id: Union[int, str]
+    dishes_count: int
+    price_min: Optional[str]
+    price_max: Optional[str]
+    price_avg: Optional[str]
+
+
+class MenuPriceStatsPy(PriceStatsPy):
+    submenus: List[PriceStatsPy]
+
+
+class TreeDishPy(MainDishPy):
+    id: Union[int, str]
+
+
+class TreeSubmenuPy(MainFieldsPy):
+    id: Union[int, str]
+    dishes_count: Union[int, str]
+    dishes: List[TreeDishPy]
+
+
+class TreeMenuPy(GetCountMenuPy):
+    submenus: List[TreeSubmenuPy]
@@ -1,22 +1,235 @@
+import time
 from os import environ
-from contextlib import contextmanager
-from sqlalchemy import create_engine
+from contextlib import contextmanager, asynccontextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Tuple, Union
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine, async_sessionmaker
 from dotenv import load_dotenv
 
+from metrics import Gauge, db_pool_wait, observe_query, registry
+
 load_dotenv()
 
 path_prefix = "/api/v1"
+page_limit = int(environ.get("PAGELIMIT", 100))
+page_max_limit = int(environ.get("PAGEMAXLIMIT", 1000))
+stream_batch_size = int(environ.get("STREAMBATCHSIZE", 1000))
 db_engine = "postgresql+psycopg2"
+db_async_engine = "postgresql+asyncpg"
 db_host = environ["DBHOST"]
 db_port = environ["DBPORT"]
 db_user = environ["DBUSER"]
 db_pswd = environ["DBPSWD"]
 db_name = environ["DBNAME"]
 db_url = f"{db_engine}://{db_user}:{db_pswd}@{db_host}:{db_port}/{db_name}"
-db_engine_sync = create_engine(db_url)
+db_statement_cache_size = int(environ.get("DBSTATEMENTCACHE", 500))
+# Реплики для чтения: host:port через запятую, те же пользователь и база
+db_replicas = [
+    replica.strip() for replica in environ.get("DBREPLICAS", "").split(",") if replica.strip()
+]
+# Сколько секунд недоступная реплика пропускается
+db_replica_retry = float(environ.get("DBREPLICARETRY", 5))
+# Сколько секунд после записи чтения клиента идут в основную базу
+db_read_your_writes = int(environ.get("DBREADYOURWRITES", 5))
+READ_YOUR_WRITES_COOKIE = "ylab-primary"
+
+
+def get_async_url(host: str, port: str) -> str:
+    return (
+        f"{db_async_engine}://{db_user}:{db_pswd}@{host}:{port}/{db_name}"
+        f"?prepared_statement_cache_size={db_statement_cache_size}"
+    )
+
+
+db_async_url = get_async_url(db_host, db_port)
+
+db_pool_options = {
+    "pool_size": int(environ.get("DBPOOLSIZE", 5)),
+    "max_overflow": int(environ.get("DBPOOLOVERFLOW", 10)),
+    "pool_recycle": int(environ.get("DBPOOLRECYCLE", 1800)),
+    "pool_pre_ping": environ.get("DBPOOLPREPING", "true").lower() == "true",
+    "pool_timeout": float(environ.get("DBPOOLTIMEOUT", 30)),
+}
+
+
+class PoolWaitMixin:
+    """
+    Учёт времени получения соединения из пула
+    """
+    engine_name = ""
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            db_pool_wait.observe(time.perf_counter() - started, engine=self.engine_name)
+
+
+class MeteredQueuePool(PoolWaitMixin, QueuePool):
+    engine_name = "sync"
+
+
+class MeteredAsyncQueuePool(PoolWaitMixin, AsyncAdaptedQueuePool):
+    engine_name = "async"
+
+
+db_engine_sync = create_engine(db_url, poolclass=MeteredQueuePool, **db_pool_options)
+db_engine_async = create_async_engine(
+    db_async_url, poolclass=MeteredAsyncQueuePool, **db_pool_options
+)
+db_engines_replica = [
+    create_async_engine(
+        get_async_url(*replica.rsplit(":", 1)), poolclass=MeteredAsyncQueuePool, **db_pool_options
+    )
+    for replica in db_replicas
+]
+session_factory = sessionmaker(bind=db_engine_sync, expire_on_commit=True)
+async_session_factory = async_sessionmaker(bind=db_engine_async, expire_on_commit=True)
+# "replica" - запрос только читает и может идти в реплику
+db_route: ContextVar[str] = ContextVar("db_route", default="primary")
+
+
+class ReplicaSet:
+    """
+    Реплики по кругу; недоступная пропускается retry секунд,
+    затем снова пробуется
+    """
+
+    def __init__(self, engines: List[AsyncEngine], retry: float):
+        self.engines = engines
+        self.retry = retry
+        self.position = 0
+        self.down_until: Dict[int, float] = {}
+
+    def candidates(self) -> List[Tuple[int, AsyncEngine]]:
+        count = len(self.engines)
+        if not count:
+            return []
+        start = self.position
+        self.position = (start + 1) % count
+        now = time.monotonic()
+        return [
+            (index, self.engines[index])
+            for index in ((start + offset) % count for offset in range(count))
+            if self.down_until.get(index, 0) <= now
+        ]
+
+    def mark_down(self, index: int) -> None:
+        self.down_until[index] = time.monotonic() + self.retry
+
+    def is_down(self, index: int) -> bool:
+        return self.down_until.get(index, 0) > time.monotonic()
+
+
+replica_set = ReplicaSet(db_engines_replica, db_replica_retry)
+
+
+async def open_async_session() -> AsyncSession:
+    """
+    Сессия в реплике для читающих запросов, если есть доступная,
+    иначе в основной базе
+    """
+    if db_route.get() == "replica":
+        for index, engine in replica_set.candidates():
+            session = async_session_factory(bind=engine)
+            try:
+                await session.connection()
+                return session
+            except Exception:
+                # Любая ошибка соединения - реплика считается недоступной
+                await session.close()
+                replica_set.mark_down(index)
+    return async_session_factory()
+
 
 @contextmanager
 def get_session():
-    session = sessionmaker(bind=db_engine_sync, expire_on_commit=True)
-    yield session()
\ No newline at end of file
+    """
+    Синхронная сессия: фиксация при успехе, откат при ошибке,
+    соединение всегда возвращается в пул
+    """
+    session = session_factory()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+@asynccontextmanager
+async def get_async_session():
+    """
+    Асинхронная сессия для обработчиков API: фиксация при успехе,
+    откат при ошибке, соединение всегда возвращается в пул
+    """
+    session = await open_async_session()
+    try:
+        yield session
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
+
+
+def get_pool_stats() -> Dict[str, Dict[str, Union[int, float, bool]]]:
+    """
+    Состояние пулов соединений для подбора их размера
+    """
+    stats = {}
+    engines = [("sync", db_engine_sync), ("async", db_engine_async.sync_engine)] + [
+        (f"replica{index}", engine.sync_engine) for index, engine in enumerate(db_engines_replica)
+    ]
+    for name, engine in engines:
+        pool = engine.pool
+        stats[name] = {
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "max_overflow": db_pool_options["max_overflow"],
+            "timeout": db_pool_options["pool_timeout"],
+            "recycle": db_pool_options["pool_recycle"],
+            "pre_ping": db_pool_options["pool_pre_ping"],
+        }
+    for index in range(len(db_engines_replica)):
+        stats[f"replica{index}"]["down"] = replica_set.is_down(index)
+    return stats
+
+
+def instrument_engine(engine, name: str) -> None:
+    """
+    Учёт числа и времени запросов движка, в том числе по HTTP-запросу
+    """
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        context.query_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        observe_query(name, context.query_started)
+
+
+def collect_pool_stats() -> Dict[tuple, int]:
+    return {
+        (("engine", engine), ("state", state)): stats[state]
+        for engine, stats in get_pool_stats().items()
+        for state in ("checked_in", "checked_out", "overflow")
+    }
+
+
+instrument_engine(db_engine_sync, "sync")
+instrument_engine(db_engine_async.sync_engine, "async")
+for index, engine in enumerate(db_engines_replica):
+    instrument_engine(engine.sync_engine, f"replica{index}")
+registry.register(Gauge(
+    "db_pool_connections", "Pool connections by engine and state", collect_pool_stats
+))
@@ -1,33 +1,47 @@
+import asyncio
 import requests
 import pytest
 import json
 import os
+import time
 
-from typing import Dict
+from typing import Dict, List
 from collections import defaultdict
+from contextlib import asynccontextmanager
 
 from utils import *
+from session import READ_YOUR_WRITES_COOKIE, db_engine_async
+from cache import MemoryCache
+from jobs import create_delete_job, delete_job_attempts, get_job, resume_jobs, run_delete_job
+from warmup import WarmUp
 
 app_host = os.environ["APPHOST"]
 app_port = os.environ["APPPORT"]
 
 
 storage = defaultdict(str)
+# Общие cookie: после записи чтения идут в основную базу, а не в реплику
+client = requests.Session()
 
 
 async def get_last_row_id(table: str):
     all_rows = await get_rows(table=table)
-    assert not all_rows.empty, f"Missing any rows in {table} table"
-    return all_rows.sort_values("id", ascending=False).iloc[0]["id"]
+    assert all_rows, f"Missing any rows in {table} table"
+    return max(row["id"] for row in all_rows)
 
 
-async def send_request(method, path, data):
+async def send_request(method, path, data, headers=None, raw=False):
     """
-    Отправка запроса
+    Отправка запроса; с raw тело отправляется как есть, без JSON
     """
     url = f"http://{app_host}:{app_port}{path_prefix}{path}"
-    data = json.dumps(data)
-    response = requests.request(method, url=url, data=data)
+    if not raw:
+        data = json.dumps(data)
+    response = client.request(method, url=url, data=data, headers=headers)
+    budget = response.headers.get("X-Query-Budget")
+    if budget is not None:
+        queries = int(response.headers["X-Query-Count"])
+        assert queries <= int(budget), f"Query budget error: {method} {path} {queries} > {budget}"
     return response
 
 
@@ -67,12 +81,13 @@ async def update_row_test(
     """
     Проверка изменения записи
     """
+    conditions = {column: int(value) for column, value in conditions.items()}
     prev_data = await get_rows(
         table=table,
         conditions=conditions,
     )
-    assert not prev_data.empty, f"Missing row in {table} table"
-    prev_data = prev_data.to_dict(orient="records")[0]
+    assert prev_data, f"Missing row in {table} table"
+    prev_data = prev_data[0]
     res = await send_request(method="PATCH", path=path, data=data)
     res_data = res.json()
     assert res.status_code == 200, "Status code error"
@@ -89,19 +104,49 @@ async def delete_row_test(
     """
     Проверка удаления записи
     """
+    conditions = {column: int(value) for column, value in conditions.items()}
     prev_data = await get_rows(
         table=table,
         conditions=conditions,
     )
-    assert not prev_data.empty, f"Missing row in {table} table"
-    prev_data = prev_data.to_dict(orient="records")[0]
+    assert prev_data, f"Missing row in {table} table"
+    prev_data = prev_data[0]
     res = await send_request(method="DELETE", path=path, data=None)
     assert res.status_code == 200, "Status code error"
     curr_data = await get_rows(
         table=table,
         conditions=conditions,
     )
-    assert curr_data.empty, "Row wasn't delete"
+    assert not curr_data, "Row wasn't delete"
+
+
+async def next_row_id(table: str) -> int:
+    """
+    Id сразу за последней записью таблицы
+    """
+    return max((row["id"] for row in await get_rows(table=table)), default=0) + 1
+
+
+@asynccontextmanager
+async def catalog_menu(title: str, description: str, submenus: List[dict] = ()):
+    """
+    Меню с подменю и блюдами из одного bulk-запроса;
+    отдаёт id меню и созданные подменю, при выходе меню удаляется
+    """
+    res = await send_request(method="POST", path="/menus", data={"title": title, "description": description})
+    assert res.status_code == 201, "Status code error"
+    menu_id = res.json()["id"]
+    try:
+        created = []
+        if submenus:
+            res = await send_request(
+                method="POST", path=f"/menus/{menu_id}/submenus/bulk", data=list(submenus)
+            )
+            assert res.status_code == 201, "Status code error"
+            created = res.json()
+        yield menu_id, created
+    finally:
+        await send_request(method="DELETE", path=f"/menus/{menu_id}", data=None)
 
 
 @pytest.mark.asyncio
@@ -269,4 +314,788 @@ async def test_delete_menu():
         table="menu",
         conditions={"id": last_menu_id}
     )
-    return True
\ No newline at end of file
+    return True
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_pool_stats():
+    res = await send_request(method="GET", path="/service/pool", data=None)
+    assert res.status_code == 200, "Status code error"
+    for name in ("sync", "async"):
+        assert res.json()[name]["checked_out"] >= 0, f"Pool {name} error"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_cache_invalidation():
+    async with catalog_menu("Cached menu", "Cached") as (menu_id, _):
+        res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+        assert res.json()["dishes_count"] == 0, "Dishes count error"
+        res = await send_request(
+            method="POST", path=f"/menus/{menu_id}/submenus", data={"title": "Cached", "description": "Cached"}
+        )
+        submenu_id = res.json()["id"]
+        await send_request(
+            method="POST",
+            path=f"/menus/{menu_id}/submenus/{submenu_id}/dishes",
+            data={"title": "Cached dish", "description": "Cached", "price": "1.50"},
+        )
+        res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+        assert res.json()["submenus_count"] == 1, "Stale submenus count"
+        assert res.json()["dishes_count"] == 1, "Stale dishes count"
+        res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+        assert res.json()["dishes_count"] == 1, "Cached dishes count error"
+    res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+    assert res.status_code == 404, "Deleted menu is still cached"
+    res = await send_request(method="GET", path="/service/cache", data=None)
+    assert res.json()["hits"] >= 1, "Cache hits error"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_bulk_create():
+    res = await send_request(
+        method="POST", path="/menus", data={"title": "Bulk menu", "description": "Bulk"}
+    )
+    menu_id = res.json()["id"]
+    res = await send_request(
+        method="POST",
+        path=f"/menus/{menu_id}/submenus/bulk",
+        data=[
+            {
+                "title": "Bulk submenu",
+                "description": "Bulk",
+                "dishes": [
+                    {"title": "Bulk dish 1", "description": "Bulk", "price": "1.50"},
+                    {"title": "Bulk dish 2", "description": "Bulk", "price": "2.50"},
+                ],
+            },
+            {"title": "Empty submenu", "description": "Bulk"},
+        ],
+    )
+    assert res.status_code == 201, "Status code error"
+    submenu_id = res.json()[0]["id"]
+    assert [dish["price"] for dish in res.json()[0]["dishes"]] == ["1.50", "2.50"], "Dishes error"
+    res = await send_request(
+        method="POST",
+        path=f"/menus/{menu_id}/submenus/{submenu_id}/dishes/bulk",
+        data=[{"title": "Bulk dish 3", "description": "Bulk", "price": "3.50"}],
+    )
+    assert res.status_code == 201, "Status code error"
+    dish_id = res.json()[0]["id"]
+    dish = await get_rows(table="dish", conditions={"id": int(dish_id)})
+    assert dish and dish[0]["submenu_id"] == int(submenu_id), "Returned id error"
+    res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+    assert res.json()["submenus_count"] == 2, "Submenus count error"
+    assert res.json()["dishes_count"] == 3, "Dishes count error"
+    await send_request(method="DELETE", path=f"/menus/{menu_id}", data=None)
+    res = await send_request(
+        method="POST",
+        path=f"/menus/{menu_id}/submenus/bulk",
+        data=[{"title": "Orphan submenu", "description": "Bulk"}],
+    )
+    assert res.status_code == 404, "Missing menu error"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_pagination():
+    submenus = [{"title": f"Paged submenu {number}", "description": "Paged"} for number in range(5)]
+    async with catalog_menu("Paged menu", "Paged", submenus) as (menu_id, submenus):
+        created_ids = [int(submenu["id"]) for submenu in submenus]
+        received_ids = []
+        path = f"/menus/{menu_id}/submenus?limit=2"
+        while path is not None:
+            res = await send_request(method="GET", path=path, data=None)
+            assert res.status_code == 200, "Status code error"
+            assert len(res.json()) <= 2, "Page size error"
+            received_ids += [submenu["id"] for submenu in res.json()]
+            cursor = res.headers.get("X-Next-Cursor")
+            path = f"/menus/{menu_id}/submenus?limit=2&cursor={cursor}" if cursor else None
+        assert received_ids == created_ids, "Pages error"
+        res = await send_request(method="GET", path=f"/menus/{menu_id}/submenus/{created_ids[0]}/dishes", data=None)
+        assert res.json() == [], "Dishes scope error"
+        res = await send_request(method="GET", path=f"/menus/{int(menu_id) + 1}/submenus", data=None)
+        assert not set(created_ids) & {submenu["id"] for submenu in res.json()}, "Submenus scope error"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_ndjson_stream():
+    submenus = [
+        {
+            "title": "Stream submenu",
+            "description": "Stream",
+            "dishes": [
+                {"title": f"Stream dish {number}", "description": "Stream", "price": "1.50"}
+                for number in range(3)
+            ],
+        },
+    ]
+    async with catalog_menu("Stream menu", "Stream", submenus) as (menu_id, submenus):
+        path = f"/menus/{menu_id}/submenus/{submenus[0]['id']}/dishes?limit=1"
+        res = await send_request(method="GET", path=path, data=None)
+        assert len(res.json()) == 1, "Page size error"
+        assert res.json()[0]["price"] == "1.50", "Price error"
+        res = await send_request(
+            method="GET", path=path, data=None, headers={"Accept": "application/x-ndjson"}
+        )
+        assert res.status_code == 200, "Status code error"
+        assert res.headers["content-type"].startswith("application/x-ndjson"), "Content type error"
+        dishes = [json.loads(line) for line in res.text.splitlines()]
+        assert [dish["title"] for dish in dishes] == [f"Stream dish {number}" for number in range(3)], "Stream error"
+        assert {dish["price"] for dish in dishes} == {"1.50"}, "Price error"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_menu_tree():
+    submenus = [
+        {
+            "title": "Tree submenu",
+            "description": "Tree",
+            "dishes": [
+                {"title": "Tree dish 1", "description": "Tree", "price": "1.50"},
+                {"title": "Tree dish 2", "description": "Tree", "price": "2"},
+            ],
+        },
+        {"title": "Empty tree submenu", "description": "Tree"},
+    ]
+    async with catalog_menu("Tree menu", "Tree", submenus) as (menu_id, _):
+        res = await send_request(method="GET", path=f"/menus/{menu_id}/tree", data=None)
+        assert res.status_code == 200, "Status code error"
+        tree = res.json()
+        assert tree["submenus_count"] == 2 and tree["dishes_count"] == 2, "Counts error"
+        assert [submenu["dishes_count"] for submenu in tree["submenus"]] == [2, 0], "Submenus error"
+        assert [dish["price"] for dish in tree["submenus"][0]["dishes"]] == ["1.50", "2.00"], "Dishes error"
+        res = await send_request(method="GET", path=f"/menus/tree?cursor={int(menu_id) - 1}&limit=1", data=None)
+        assert res.json() == [tree], "Menus tree error"
+    res = await send_request(method="GET", path=f"/menus/{menu_id}/tree", data=None)
+    assert res.status_code == 404, "Status code error"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_etag():
+    async with catalog_menu("Etag menu", "Etag") as (menu_id, _):
+        res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+        etag = res.headers["ETag"]
+        res = await send_request(
+            method="GET", path=f"/menus/{menu_id}", data=None, headers={"If-None-Match": etag}
+        )
+        assert res.status_code == 304, "Not modified error"
+        res = await send_request(
+            method="POST", path=f"/menus/{menu_id}/submenus", data={"title": "Etag", "description": "Etag"}
+        )
+        submenu_id = res.json()["id"]
+        res = await send_request(
+            method="GET", path=f"/menus/{menu_id}", data=None, headers={"If-None-Match": etag}
+        )
+        assert res.status_code == 200, "Modified menu error"
+        assert res.headers["ETag"] != etag, "ETag error"
+        res = await send_request(
+            method="POST",
+            path=f"/menus/{int(menu_id) + 1}/submenus/{submenu_id}/dishes",
+            data={"title": "Etag dish", "description": "Etag", "price": "1.50"},
+        )
+        assert res.status_code == 404, "Foreign submenu error"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_version_scope():
+    menu_ids = []
+    for title in ("Scope menu A", "Scope menu B"):
+        res = await send_request(method="POST", path="/menus", data={"title": title, "description": "Scope"})
+        menu_ids.append(int(res.json()["id"]))
+    menu_a, menu_b = menu_ids
+    tree_path = f"/menus/tree?cursor={menu_a - 1}&limit=1"
+    menus_etag = (await send_request(method="GET", path="/menus", data=None)).headers["ETag"]
+    tree_etag = (await send_request(method="GET", path=tree_path, data=None)).headers["ETag"]
+    await send_request(
+        method="POST", path=f"/menus/{menu_a}/submenus", data={"title": "Scope", "description": "Scope"}
+    )
+    res = await send_request(method="GET", path="/menus", data=None)
+    assert res.headers["ETag"] == menus_etag, "Catalog version error"
+    res = await send_request(method="GET", path=tree_path, data=None)
+    assert res.headers["ETag"] != tree_etag, "Tree page version error"
+    assert len(res.json()[0]["submenus"]) == 1, "Tree page error"
+    # Открытая запись в меню A не блокирует запись в меню B
+    async with get_async_session() as session:
+        await bump_versions(menu_id=menu_a, session=session)
+        res = client.patch(
+            f"http://{app_host}:{app_port}{path_prefix}/menus/{menu_b}",
+            json={"title": "Scope menu B", "description": "Patched"},
+            timeout=5,
+        )
+        assert res.status_code == 200, "Status code error"
+    missing_id = 10 ** 6 + menu_b
+    await send_request(method="PATCH", path=f"/menus/{missing_id}", data={"title": "None", "description": "None"})
+    await send_request(method="DELETE", path=f"/menus/{missing_id}", data=None)
+    assert await get_version(menu_id=missing_id) == 0, "Missing menu version error"
+    for menu_id in menu_ids:
+        await send_request(method="DELETE", path=f"/menus/{menu_id}", data=None)
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_cache_version():
+    submenus = [{"title": "Cached", "description": "Version"}]
+    async with catalog_menu("Version menu", "Version", submenus) as (menu_id, submenus):
+        path = f"/menus/{menu_id}/submenus/{submenus[0]['id']}"
+        assert (await send_request(method="GET", path=path, data=None)).json()["title"] == "Cached"
+        # Запись без сброса кеша и уведомления, но с новой версией меню
+        async with get_async_session() as session:
+            await session.execute(
+                text("UPDATE submenu SET title = 'Fresh' WHERE id = :submenu_id"),
+                {"submenu_id": int(submenus[0]["id"])},
+            )
+            await session.execute(
+                text("UPDATE menu_version SET version = version + 1 WHERE menu_id = :menu_id"),
+                {"menu_id": int(menu_id)},
+            )
+        res = await send_request(method="GET", path=path, data=None)
+        assert res.json()["title"] == "Fresh", "Cache version error"
+    return True
+
+
+@asynccontextmanager
+async def database_down():
+    """
+    Недоступная база: новые соединения запрещены, открытые закрыты
+    """
+    import asyncpg
+
+    url = db_engine_async.url
+    connection = await asyncpg.connect(
+        url.set(drivername="postgresql", database="postgres", query={}).render_as_string(
+            hide_password=False
+        )
+    )
+    try:
+        await connection.execute(f'ALTER DATABASE "{url.database}" ALLOW_CONNECTIONS false')
+        await connection.execute(
+            "SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = $1",
+            url.database,
+        )
+        yield
+    finally:
+        await connection.execute(f'ALTER DATABASE "{url.database}" ALLOW_CONNECTIONS true')
+        await connection.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_cache_fallback():
+    async with catalog_menu("Fallback menu", "Fallback") as (menu_id, _):
+        path = f"/menus/{menu_id}"
+        menu = (await send_request(method="GET", path=path, data=None)).json()
+        async with database_down():
+            res = await send_request(method="GET", path=path, data=None)
+            assert res.status_code == 200, "Status code error"
+            assert res.json() == menu, "Cache fallback error"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_cache_groups():
+    cache = MemoryCache(max_size=10)
+    for key in ("menu:1#1", "menu:1:submenu:2#1", "menu:12#1", "menus?cursor=0&limit=10#3"):
+        await cache.set(key, {}, time.time() + 60, 0)
+    # Сброс меню 1 и списка не задевает меню 12 с тем же началом ключа
+    await cache.delete([], ["menu:1#", "menu:1:", "menus?"])
+    assert list(cache.entries) == ["menu:12#1"], "Invalidation error"
+    assert list(cache.groups) == ["menu:12"], "Groups error"
+    await cache.delete([], [""])
+    assert not cache.entries and not cache.groups, "Clear error"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_catalog_copy():
+    async with catalog_menu("Copy menu", "Copy") as (menu_id, _):
+        await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+        res = await send_request(method="GET", path="/admin/catalog/menu?format=csv", data=None)
+        assert res.status_code == 200, "Status code error"
+        lines = res.text.splitlines()
+        assert lines[0] == "id,title,description", "Header error"
+        assert f"{menu_id},Copy menu,Copy" in lines, "Export error"
+        res = await send_request(
+            method="POST",
+            path="/admin/catalog/menu?format=csv",
+            data=f"{lines[0]}\n{menu_id},\"Copy, imported\",Copy\n",
+            raw=True,
+        )
+        assert res.status_code == 200 and res.json()["rows"] == 1, "Import error"
+        res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+        assert res.json()["title"] == "Copy, imported", "Imported menu error"
+        # Новый id сразу за последним: загрузка сдвигает последовательность к нему
+        submenu_id = await next_row_id("submenu")
+        path = "/admin/catalog/submenu?format=json"
+        submenu = {"id": submenu_id, "title": "Copy", "description": "Copy", "menu_id": int(menu_id)}
+        res = await send_request(method="POST", path=path, data=json.dumps(submenu), raw=True)
+        assert res.status_code == 200, "Import error"
+        # Перенос подменю загрузкой обновляет и прежнее меню
+        async with catalog_menu("Copy target", "Copy") as (target_id, _):
+            res = await send_request(
+                method="POST", path=path, data=json.dumps(submenu | {"menu_id": int(target_id)}), raw=True
+            )
+            assert res.status_code == 200, "Import error"
+            res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+            assert res.json()["submenus_count"] == 0, "Previous menu error"
+            res = await send_request(method="GET", path=f"/menus/{target_id}", data=None)
+            assert res.json()["submenus_count"] == 1, "Target menu error"
+            path = "/admin/catalog/dish?format=json"
+            dish = {
+                "id": await next_row_id("dish"),
+                "title": "Copy",
+                "description": "Copy",
+                "price": 0,
+                "submenu_id": submenu_id,
+            }
+            res = await send_request(method="POST", path=path, data=json.dumps(dish), raw=True)
+            assert res.status_code == 400, "Price check error"
+            res = await send_request(method="POST", path=path, data=json.dumps(dish | {"price": 1}), raw=True)
+            assert res.status_code == 200, "Import error"
+            res = await send_request(method="GET", path=f"/menus/{target_id}", data=None)
+            assert res.json()["dishes_count"] == 1, "Target dishes error"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_metrics():
+    await send_request(method="GET", path="/menus", data=None)
+    res = requests.get(f"http://{app_host}:{app_port}/metrics")
+    assert res.status_code == 200, "Status code error"
+    assert res.headers["content-type"].startswith("text/plain"), "Content type error"
+    assert f'http_request_queries_count{{route="{path_prefix}/menus"}}' in res.text, "Route metrics error"
+    for name in ("db_pool_checkout_seconds", "db_query_duration_seconds", "cache_hit_ratio"):
+        assert f"# TYPE {name} " in res.text, f"Metric {name} error"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_query_budget():
+    async with catalog_menu("Budget menu", "Budget") as (menu_id, _):
+        res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+        assert res.headers["X-Query-Budget"] == "2", "Budget header error"
+        assert int(res.headers["X-Query-Count"]) == 2, "Query count error"
+        res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+        assert int(res.headers["X-Query-Count"]) == 1, "Cached query count error"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_bulk_update_delete():
+    submenus = [
+        {
+            "title": "Batch submenu",
+            "description": "Batch",
+            "dishes": [
+                {"title": f"Batch dish {price}", "description": "Batch", "price": price}
+                for price in ("1.00", "2.00", "3.00")
+            ],
+        },
+    ]
+    async with catalog_menu("Batch menu", "Batch", submenus) as (menu_id, submenus):
+        submenu_id = submenus[0]["id"]
+        dish_ids = [dish["id"] for dish in submenus[0]["dishes"]]
+        path = f"/menus/{menu_id}/submenus/{submenu_id}/dishes"
+        await send_request(method="GET", path=path, data=None)
+        res = await send_request(
+            method="PATCH",
+            path=f"{path}/bulk",
+            data={"prices": [{"id": dish_ids[0], "price": "5.00"}, {"id": 10 ** 9, "price": "1"}]},
+        )
+        assert res.status_code == 200, "Status code error"
+        assert res.json()["ids"] == [dish_ids[0]], "Updated ids error"
+        res = await send_request(method="PATCH", path=f"{path}/bulk", data={"percent": 10})
+        assert sorted(res.json()["ids"]) == sorted(dish_ids), "Updated ids error"
+        res = await send_request(method="GET", path=path, data=None)
+        assert [dish["price"] for dish in res.json()] == ["5.50", "2.20", "3.30"], "Prices error"
+        res = await send_request(method="PATCH", path=f"{path}/bulk", data={})
+        assert res.status_code == 400, "Validation error"
+        res = await send_request(
+            method="DELETE", path=f"{path}/bulk?ids={dish_ids[0]}&ids={dish_ids[1]}", data=None
+        )
+        assert res.status_code == 200, "Status code error"
+        assert sorted(res.json()["ids"]) == sorted(dish_ids[:2]), "Deleted ids error"
+        res = await send_request(method="GET", path=path, data=None)
+        assert [dish["id"] for dish in res.json()] == [int(dish_ids[2])], "Delete error"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_read_your_writes():
+    res = await send_request(
+        method="POST", path="/menus", data={"title": "Primary menu", "description": "Primary"}
+    )
+    assert READ_YOUR_WRITES_COOKIE in res.cookies, "Cookie error"
+    menu_id = res.json()["id"]
+    res = await send_request(
+        method="GET",
+        path=f"/menus/{menu_id}",
+        data=None,
+        headers={"Cookie": f"{READ_YOUR_WRITES_COOKIE}=1"},
+    )
+    assert res.status_code == 200, "Read your writes error"
+    assert READ_YOUR_WRITES_COOKIE not in res.cookies, "Cookie error"
+    await send_request(method="DELETE", path=f"/menus/{menu_id}", data=None)
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_cache_notify():
+    async with catalog_menu("Notify menu", "Notify") as (menu_id, _):
+        res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+        assert res.json()["title"] == "Notify menu", "Title error"
+        # Запись из другого процесса: сервер узнаёт о ней только через NOTIFY
+        await update_row(
+            data={"title": "Notified menu"},
+            table="menu",
+            conditions={"id": int(menu_id)},
+            menu_id=int(menu_id),
+        )
+        for _ in range(40):
+            res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+            if res.json()["title"] == "Notified menu":
+                break
+            await asyncio.sleep(0.05)
+        assert res.json()["title"] == "Notified menu", "Notify invalidation error"
+        res = await send_request(method="GET", path="/service/cache", data=None)
+        assert res.json()["notifications"] > 0, "Notifications error"
+    return True
+
+
+async def wait_job(job_id: str) -> dict:
+    """
+    Ожидание завершения фоновой задачи
+    """
+    for _ in range(100):
+        res = await send_request(method="GET", path=f"/admin/jobs/{job_id}", data=None)
+        assert res.status_code == 200, "Status code error"
+        if res.json()["status"] in ("done", "failed"):
+            break
+        await asyncio.sleep(0.05)
+    return res.json()
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_background_delete():
+    submenus = [
+        {
+            "title": f"Job submenu {number}",
+            "description": "Job",
+            "dishes": [{"title": "Job dish", "description": "Job", "price": "1.50"}] * 3,
+        }
+        for number in range(2)
+    ]
+    async with catalog_menu("Job menu", "Job", submenus) as (menu_id, submenus):
+        submenu_ids = [submenu["id"] for submenu in submenus]
+        res = await send_request(
+            method="DELETE", path=f"/menus/{menu_id}/submenus/{submenu_ids[0]}?background=true", data=None
+        )
+        assert res.status_code == 202, "Status code error"
+        res = await send_request(method="GET", path=f"/menus/{menu_id}/submenus/{submenu_ids[0]}", data=None)
+        assert res.status_code == 404, "Hidden submenu error"
+        res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+        assert res.json()["submenus_count"] == 1, "Submenus count error"
+        assert res.json()["dishes_count"] == 3, "Dishes count error"
+        res = await send_request(method="DELETE", path=f"/menus/{menu_id}?background=true", data=None)
+        assert res.status_code == 202, "Status code error"
+        job_id = res.json()["job_id"]
+        res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+        assert res.status_code == 404, "Hidden menu error"
+        res = await send_request(method="DELETE", path=f"/menus/{menu_id}?background=true", data=None)
+        assert res.status_code == 404, "Repeated delete error"
+        job = await wait_job(job_id)
+    assert job["status"] == "done", f"Job error: {job['error']}"
+    assert job["deleted"] >= 5, "Deleted rows error"
+    assert not await get_rows(table="menu", conditions={"id": int(menu_id)}), "Menu wasn't delete"
+    for submenu_id in submenu_ids:
+        assert not await get_rows(table="dish", conditions={"submenu_id": int(submenu_id)}), "Dishes weren't delete"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_deleting_menu():
+    submenus = [{"title": "Deleting submenu", "description": "Deleting"}]
+    async with catalog_menu("Deleting menu", "Deleting", submenus) as (menu_id, submenus):
+        # Задача создаётся, но не запускается: меню остаётся помеченным
+        job_id = await create_delete_job("menu", int(menu_id), int(menu_id))
+        # Подменю, вставленное в обход проверки, пока меню помечается
+        late_id = await create_row(
+            data={"title": "Late submenu", "description": "Deleting", "menu_id": int(menu_id)},
+            table="submenu",
+            menu_id=int(menu_id),
+        )
+        path = f"/menus/{menu_id}/submenus"
+        res = await send_request(method="POST", path=path, data={"title": "New", "description": "Deleting"})
+        assert res.status_code == 404, "Submenu create error"
+        res = await send_request(method="POST", path=f"{path}/bulk", data=[{"title": "New", "description": "Deleting"}])
+        assert res.status_code == 404, "Bulk create error"
+        res = await send_request(method="GET", path=path, data=None)
+        assert res.json() == [], "Submenu list error"
+        res = await send_request(method="GET", path=path, data=None, headers={"Accept": "application/x-ndjson"})
+        assert res.text == "", "Submenu stream error"
+        res = await send_request(method="GET", path=f"{path}/{late_id}", data=None)
+        assert res.status_code == 404, "Submenu detail error"
+        await run_delete_job(job_id)
+    assert (await get_job(job_id))["status"] == "done", "Job error"
+    return True
+
+
+async def fail_job(job_id: int, attempts: int) -> None:
+    """
+    Перевод задачи в упавшие давно и с заданным числом попыток
+    """
+    async with get_async_session() as session:
+        await session.execute(
+            text(
+                """
+                UPDATE delete_job
+                SET status = 'failed', attempts = :attempts, updated_at = now() - interval '1 day'
+                WHERE id = :job_id
+                """
+            ),
+            {"job_id": job_id, "attempts": attempts},
+        )
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_failed_job():
+    async with catalog_menu("Failed menu", "Failed") as (menu_id, _):
+        job_id = await create_delete_job("menu", int(menu_id), int(menu_id))
+        await fail_job(job_id, attempts=1)
+        # Повторный запрос удаления перезапускает упавшую задачу
+        res = await send_request(method="DELETE", path=f"/menus/{menu_id}?background=true", data=None)
+        assert res.status_code == 202 and res.json()["job_id"] == str(job_id), "Retry error"
+        assert (await wait_job(job_id))["status"] == "done", "Job error"
+    async with catalog_menu("Failed menu", "Failed") as (menu_id, _):
+        job_id = await create_delete_job("menu", int(menu_id), int(menu_id))
+        # Исчерпавшая попытки задача не повторяется
+        await fail_job(job_id, attempts=delete_job_attempts)
+        await resume_jobs()
+        assert (await get_job(job_id))["status"] == "failed", "Attempts error"
+        # Упавшая задача повторяется поиском брошенных
+        await fail_job(job_id, attempts=1)
+        await resume_jobs()
+        job = await wait_job(job_id)
+        assert job["status"] == "done" and job["attempts"] == 1, "Resume error"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_ready():
+    for _ in range(50):
+        res = requests.get(f"http://{app_host}:{app_port}/ready")
+        if res.status_code == 200:
+            break
+        assert res.status_code == 503, "Status code error"
+        await asyncio.sleep(0.1)
+    data = res.json()
+    assert data["ready"] is True and data["error"] is None, "Ready error"
+    assert data["connections"]["async"] > 0, "Warm connections error"
+    for stage in ("import", "connections", "queries", "startup"):
+        assert data["seconds"][stage] >= 0, f"Startup time {stage} error"
+
+    async def failing_app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 500, "headers": []})
+        await send({"type": "http.response.body", "body": b"error"})
+
+    # Прогрев с ошибками не даёт готовности и повторяется
+    warm_up = WarmUp(time.perf_counter())
+    task = asyncio.create_task(warm_up.run(failing_app))
+    try:
+        for _ in range(50):
+            if warm_up.error is not None:
+                break
+            await asyncio.sleep(0.1)
+        assert not warm_up.ready and "500" in warm_up.error, "Failed warm-up error"
+    finally:
+        task.cancel()
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_search():
+    submenus = [
+        {
+            "title": "Quokkadesserts",
+            "description": "Search",
+            "dishes": [
+                {"title": "Quokkacake chocolate", "description": "Dark", "price": "12.00"},
+                {"title": "Cheesecake", "description": "Quokkacake style", "price": "8.00"},
+                {"title": "Tea", "description": "Black", "price": "2.00"},
+            ],
+        },
+    ]
+    async with catalog_menu("Search menu", "Search", submenus) as (menu_id, submenus):
+        dish_ids = [int(dish["id"]) for dish in submenus[0]["dishes"]]
+        res = await send_request(method="GET", path="/search/dishes?q=quokkacak", data=None)
+        assert res.status_code == 200, "Status code error"
+        assert [dish["id"] for dish in res.json()] == dish_ids[:2], "Ranking error"
+        assert res.json()[0]["price"] == "12.00", "Price error"
+        res = await send_request(method="GET", path="/search/dishes?q=Quokkadess", data=None)
+        assert sorted(dish["id"] for dish in res.json()) == dish_ids, "Submenu search error"
+        res = await send_request(
+            method="GET", path="/search/dishes?q=quokkadess&min_price=5&max_price=10", data=None
+        )
+        assert [dish["id"] for dish in res.json()] == [dish_ids[1]], "Price filter error"
+        res = await send_request(
+            method="GET", path=f"/search/dishes?q=quokkadess&menu_id={int(menu_id) + 1}", data=None
+        )
+        assert res.json() == [], "Menu filter error"
+        res = await send_request(method="GET", path="/search/dishes?q=quokkadess&limit=2", data=None)
+        assert res.headers["X-Next-Offset"] == "2", "Next offset error"
+        res = await send_request(
+            method="GET", path="/search/dishes?q=quokkadess&limit=2&offset=2", data=None
+        )
+        assert len(res.json()) == 1 and "X-Next-Offset" not in res.headers, "Last page error"
+        res = await send_request(method="GET", path="/search/dishes?q=%26%21", data=None)
+        assert res.status_code == 400, "Empty query error"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_price_stats():
+    submenus = [
+        {
+            "title": "Stats submenu",
+            "description": "Stats",
+            "dishes": [
+                {"title": f"Stats dish {price}", "description": "Stats", "price": price}
+                for price in ("1.00", "2.00", "6.00")
+            ],
+        },
+        {"title": "Empty submenu", "description": "Stats"},
+    ]
+    async with catalog_menu("Stats menu", "Stats", submenus) as (menu_id, submenus):
+        submenu_id, empty_id = [int(submenu["id"]) for submenu in submenus]
+        dish_ids = [dish["id"] for dish in submenus[0]["dishes"]]
+        res = await send_request(method="GET", path=f"/menus/{menu_id}/stats", data=None)
+        assert res.status_code == 200, "Status code error"
+        stats = res.json()
+        assert stats["dishes_count"] == 3, "Menu count error"
+        assert (stats["price_min"], stats["price_max"], stats["price_avg"]) == ("1.00", "6.00", "3.00"), "Menu prices error"
+        assert [submenu["id"] for submenu in stats["submenus"]] == [submenu_id, empty_id], "Submenus error"
+        assert stats["submenus"][1] == {
+            "id": empty_id, "dishes_count": 0, "price_min": None, "price_max": None, "price_avg": None
+        }, "Empty submenu error"
+        path = f"/menus/{menu_id}/submenus/{submenu_id}/dishes"
+        await send_request(
+            method="PATCH",
+            path=f"{path}/{dish_ids[2]}",
+            data={"title": "Stats dish", "description": "Stats", "price": "9.00"},
+        )
+        await send_request(method="DELETE", path=f"{path}/{dish_ids[0]}", data=None)
+        res = await send_request(method="GET", path=f"/menus/{menu_id}/stats", data=None)
+        submenu = res.json()["submenus"][0]
+        assert submenu["dishes_count"] == 2, "Submenu count error"
+        assert (submenu["price_min"], submenu["price_max"], submenu["price_avg"]) == ("2.00", "9.00", "5.50"), "Submenu prices error"
+    res = await send_request(method="GET", path=f"/menus/{menu_id}/stats", data=None)
+    assert res.status_code == 404, "Deleted menu error"
+    return True
+
+
+@pytest.mark.asyncio
+@pytest.mark.base
+async def test_menu_document():
+    async with catalog_menu("Document menu", "Doc") as (menu_id, _):
+        res = await send_request(method="GET", path=f"/menus/{menu_id}/tree", data=None)
+        assert res.json()["submenus"] == [], "Empty document error"
+        res = await send_request(
+            method="POST",
+            path=f"/menus/{menu_id}/submenus",
+            data={"title": "Document submenu", "description": "Doc"},
+        )
+        submenu_id = res.json()["id"]
+        res = await send_request(
+            method="POST",
+            path=f"/menus/{menu_id}/submenus/{submenu_id}/dishes",
+            data={"title": "Document dish", "description": "Doc", "price": "3.5"},
+        )
+        dish_id = res.json()["id"]
+        await send_request(
+            method="PATCH",
+            path=f"/menus/{menu_id}/submenus/{submenu_id}",
+            data={"title": "Renamed submenu", "description": "Doc"},
+        )
+        res = await send_request(method="GET", path=f"/menus/{menu_id}/tree", data=None)
+        assert res.headers["content-type"] == "application/json", "Content type error"
+        assert res.json()["submenus"] == [
+            {
+                "id": submenu_id,
+                "title": "Renamed submenu",
+                "description": "Doc",
+                "dishes_count": 1,
+                "dishes": [
+                    {"id": dish_id, "title": "Document dish", "description": "Doc", "price": "3.50"}
+                ],
+            }
+        ], "Tree document error"
+        res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+        assert res.json() == {
+            "id": menu_id,
+            "title": "Document menu",
+            "description": "Doc",
+            "submenus_count": 1,
+            "dishes_count": 1,
+        }, "Menu document error"
+        # Запись в одно подменю не перестраивает соседние
+        res = await send_request(
+            method="POST",
+            path=f"/menus/{menu_id}/submenus",
+            data={"title": "Second submenu", "description": "Doc"},
+        )
+        second_id = res.json()["id"]
+        await send_request(
+            method="POST",
+            path=f"/menus/{menu_id}/submenus/{second_id}/dishes",
+            data={"title": "Second dish", "description": "Doc", "price": "1"},
+        )
+        await send_request(
+            method="DELETE", path=f"/menus/{menu_id}/submenus/{submenu_id}/dishes/{dish_id}", data=None
+        )
+        res = await send_request(method="GET", path=f"/menus/{menu_id}/tree", data=None)
+        tree = res.json()
+        assert (tree["submenus_count"], tree["dishes_count"]) == (2, 1), "Tree counts error"
+        assert [submenu["id"] for submenu in tree["submenus"]] == [submenu_id, second_id], "Tree submenus error"
+        assert tree["submenus"][0]["dishes"] == [], "Touched submenu error"
+        assert [dish["title"] for dish in tree["submenus"][1]["dishes"]] == ["Second dish"], "Untouched submenu error"
+        res = await send_request(
+            method="DELETE", path=f"/menus/{menu_id}/submenus/{submenu_id}?background=true", data=None
+        )
+        assert res.status_code == 202, "Status code error"
+        job_id = res.json()["job_id"]
+        res = await send_request(method="GET", path=f"/menus/{menu_id}/tree", data=None)
+        assert [submenu["id"] for submenu in res.json()["submenus"]] == [second_id], "Deleting submenu error"
+        res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+        assert (res.json()["submenus_count"], res.json()["dishes_count"]) == (1, 1), "Deleting counts error"
+        assert (await wait_job(job_id))["status"] == "done", "Job error"
+        res = await send_request(method="GET", path=f"/menus/{menu_id}/tree", data=None)
+        assert [submenu["id"] for submenu in res.json()["submenus"]] == [second_id], "Deleted submenu error"
+    res = await send_request(method="GET", path=f"/menus/{menu_id}", data=None)
+    assert res.status_code == 404, "Deleted document error"
+    return True
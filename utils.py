@@ -1,132 +1,955 @@
-from sqlalchemy import text
-from typing import Union, Dict, List
+import json
+import re
+import orjson
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy import ColumnElement, Executable, String, TextClause, func, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
 
-import pandas as pd
+from cache import INVALIDATION_CHANNEL, invalidation_payload
+from session import (
+    get_async_session,
+    path_prefix,
+    page_limit,
+    page_max_limit,
+    stream_batch_size,
+    db_statement_cache_size,
+)
 
-from session import get_session, path_prefix
+NDJSON = "application/x-ndjson"
+# Строка menu_version с версией всего каталога
+CATALOG_VERSION = 0
+IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+# Цена в ответах - строка с двумя знаками, форматируется в запросе
+PRICE_FORMAT = "FM999999990.00"
+# Выражения поиска совпадают с индексами 0004_search_indexes.sql,
+# иначе индексы не используются
+DISH_SEARCH_VECTOR = (
+    "setweight(to_tsvector('simple', d.title), 'A')"
+    " || setweight(to_tsvector('simple', d.description), 'B')"
+)
+SUBMENU_SEARCH_VECTOR = "to_tsvector('simple', s.title)"
+SEARCH_WORD = re.compile(r"[^\W_]+")
+SEARCH_MAX_WORDS = 8
 
+# Форма условий: пары (колонка, значение - список) в порядке условий
+Shape = Tuple[Tuple[str, bool], ...]
 
-def format_value(value):
-    if isinstance(value, str):
-        return f"'{value}'"
-    elif isinstance(value, list):
-        return '(' + ", ".join(value) + ')'
-    return f"{value}"
 
+@asynccontextmanager
+async def session_scope(session: AsyncSession = None):
+    """
+    Переданная сессия (общая транзакция) либо новая
+    """
+    if session is not None:
+        yield session
+    else:
+        async with get_async_session() as session:
+            yield session
 
-def data_to_line(
-    data: Dict[str, Union[int, List[str]]],
-    sep: str = ',',
-    operator: str = "="
-) -> str:
-    lines = []
-    for column, value in data.items():
-        if isinstance(value, list):
-            operator = "IN"
-        lines.append(f"{column} {operator} {format_value(value)}")
-    return f"{sep}".join(lines)
 
+def identifier(name: str) -> str:
+    """
+    Проверка имени схемы, таблицы или колонки перед подстановкой в SQL
+    """
+    if not IDENTIFIER.match(name):
+        raise ValueError(f"invalid identifier: {name}")
+    return name
 
-async def delete_row(
+
+def conditions_shape(conditions: Dict[str, Union[int, List[int]]] = None) -> Shape:
+    return tuple(
+        (column, isinstance(value, (list, tuple)))
+        for column, value in (conditions or {}).items()
+    )
+
+
+def conditions_params(conditions: Dict[str, Union[int, List[int]]] = None) -> Dict[str, Any]:
+    return {
+        f"where_{column}": list(value) if isinstance(value, (list, tuple)) else value
+        for column, value in (conditions or {}).items()
+    }
+
+
+def where_line(shape: Shape, cursor: bool = False, alias: str = None) -> str:
+    """
+    Условия с параметрами: списки через = ANY, чтобы текст запроса
+    не зависел от их длины; alias - таблица, к колонкам которой они относятся
+    """
+    prefix = f"{identifier(alias)}." if alias else ""
+    lines = [
+        f"{prefix}{identifier(column)} = ANY(:where_{column})" if is_list
+        else f"{prefix}{identifier(column)} = :where_{column}"
+        for column, is_list in shape
+    ]
+    if cursor:
+        lines.append("id > :cursor")
+    if not lines:
+        return ""
+    return "WHERE " + " AND ".join(lines)
+
+
+@lru_cache(maxsize=db_statement_cache_size)
+def select_statement(
+    schema: str,
+    table: str,
+    shape: Shape,
+    cursor: bool,
+    limit: bool,
+    columns: Tuple[str, ...] = None,
+) -> TextClause:
+    page_line = "ORDER BY id LIMIT :limit" if limit else ""
+    column_line = ", ".join(map(identifier, columns)) if columns else "*"
+    return text(
+        f"""
+        SELECT {column_line}
+        FROM {identifier(schema)}.{identifier(table)}
+        {where_line(shape, cursor)}
+        {page_line}
+        """
+    )
+
+
+@lru_cache(maxsize=db_statement_cache_size)
+def update_statement(
+    schema: str, table: str, columns: Tuple[str, ...], shape: Shape
+) -> TextClause:
+    data_line = ", ".join(
+        f"{identifier(column)} = :value_{column}" for column in columns
+    )
+    return text(
+        f"""
+        UPDATE {identifier(schema)}.{identifier(table)}
+        SET {data_line}
+        {where_line(shape)}
+        RETURNING id
+        """
+    )
+
+
+@lru_cache(maxsize=db_statement_cache_size)
+def update_rows_statement(
+    schema: str, table: str, columns: Tuple[str, ...], shape: Shape
+) -> TextClause:
+    """
+    Обновление строк своими значениями одним запросом: строки с id
+    передаются JSON-массивом, как при вставке
+    """
+    table_line = f"{identifier(schema)}.{identifier(table)}"
+    data_line = ", ".join(
+        f"{identifier(column)} = row_data.{identifier(column)}" for column in columns
+    )
+    condition_line = where_line(shape, alias="target").replace("WHERE", "AND", 1)
+    return text(
+        f"""
+        UPDATE {table_line} AS target
+        SET {data_line}
+        FROM json_populate_recordset(NULL::{table_line}, CAST(:rows AS json)) AS row_data
+        WHERE target.id = row_data.id {condition_line}
+        RETURNING target.id
+        """
+    )
+
+
+@lru_cache(maxsize=db_statement_cache_size)
+def scale_statement(schema: str, table: str, column: str, shape: Shape) -> TextClause:
+    return text(
+        f"""
+        UPDATE {identifier(schema)}.{identifier(table)}
+        SET {identifier(column)} = round({identifier(column)} * :factor, 2)
+        {where_line(shape)}
+        RETURNING id
+        """
+    )
+
+
+@lru_cache(maxsize=db_statement_cache_size)
+def delete_statement(schema: str, table: str, shape: Shape) -> TextClause:
+    return text(
+        f"""
+        DELETE FROM {identifier(schema)}.{identifier(table)}
+        {where_line(shape)}
+        RETURNING id
+        """
+    )
+
+
+@lru_cache(maxsize=db_statement_cache_size)
+def insert_statement(schema: str, table: str, columns: Tuple[str, ...]) -> TextClause:
+    """
+    Вставка любого числа строк одним запросом: строки передаются
+    JSON-массивом и приводятся к типу строки таблицы. id выдаются
+    до вставки и возвращаются в порядке строк: порядок RETURNING
+    не гарантирован
+    """
+    table_line = f"{identifier(schema)}.{identifier(table)}"
+    column_line = ", ".join(map(identifier, columns))
+    return text(
+        f"""
+        WITH input AS MATERIALIZED (
+            SELECT nextval(pg_get_serial_sequence('{table_line}', 'id')) AS id,
+                   {column_line}, ordinality
+            FROM json_populate_recordset(NULL::{table_line}, CAST(:rows AS json))
+            WITH ORDINALITY
+            ORDER BY ordinality
+        ), inserted AS (
+            INSERT INTO {table_line} (id, {column_line})
+            SELECT id, {column_line} FROM input
+        )
+        SELECT id FROM input ORDER BY ordinality
+        """
+    )
+
+
+@lru_cache(maxsize=db_statement_cache_size)
+def refresh_statement(schema: str) -> TextClause:
+    """
+    Пересчёт статистики цен и фрагментов дерева затронутых подменю
+    :submenu_ids и документов меню :menu_ids - готовых тел ответов
+    GET /menus/{id}; остальные подменю не перестраиваются. Счётчики меню
+    берутся из новых фрагментов (RETURNING - запрос ещё не видит их
+    в таблице) и прежних фрагментов незатронутых подменю. Документы
+    удалённых и удаляемых меню и подменю удаляются. json, а не jsonb,
+    сохраняет порядок полей ответа
+    """
+    return text(
+        f"""
+        WITH stats AS (
+            INSERT INTO {schema}.submenu_price_stats
+                (submenu_id, dishes_count, price_min, price_max, price_sum)
+            SELECT s.id, count(d.id), min(d.price), max(d.price), coalesce(sum(d.price), 0)
+            FROM {schema}.submenu s
+            LEFT JOIN {schema}.dish d ON d.submenu_id = s.id
+            WHERE s.id = ANY(CAST(:submenu_ids AS BIGINT[]))
+            GROUP BY s.id
+            ON CONFLICT (submenu_id) DO UPDATE SET
+                dishes_count = EXCLUDED.dishes_count,
+                price_min = EXCLUDED.price_min,
+                price_max = EXCLUDED.price_max,
+                price_sum = EXCLUDED.price_sum
+        ), removed AS (
+            DELETE FROM {schema}.menu_document
+            WHERE menu_id = ANY(CAST(:menu_ids AS BIGINT[]))
+            AND menu_id NOT IN (
+                SELECT id FROM {schema}.menu
+                WHERE id = ANY(CAST(:menu_ids AS BIGINT[])) AND NOT deleting
+            )
+        ), removed_fragments AS (
+            DELETE FROM {schema}.submenu_document
+            WHERE submenu_id = ANY(CAST(:submenu_ids AS BIGINT[]))
+            AND submenu_id NOT IN (
+                SELECT id FROM {schema}.submenu
+                WHERE id = ANY(CAST(:submenu_ids AS BIGINT[])) AND NOT deleting
+            )
+        ), fragments AS (
+            INSERT INTO {schema}.submenu_document (submenu_id, menu_id, dishes_count, fragment)
+            SELECT s.id, s.menu_id, count(d.id),
+                   convert_to(CAST(json_build_object(
+                       'id', CAST(s.id AS TEXT),
+                       'title', s.title,
+                       'description', s.description,
+                       'dishes_count', count(d.id),
+                       'dishes', coalesce(
+                           json_agg(
+                               json_build_object(
+                                   'id', CAST(d.id AS TEXT),
+                                   'title', d.title,
+                                   'description', d.description,
+                                   'price', to_char(d.price, :price_format)
+                               ) ORDER BY d.id
+                           ) FILTER (WHERE d.id IS NOT NULL),
+                           '[]'
+                       )
+                   ) AS TEXT), 'UTF8')
+            FROM {schema}.submenu s
+            LEFT JOIN {schema}.dish d ON d.submenu_id = s.id
+            WHERE s.id = ANY(CAST(:submenu_ids AS BIGINT[])) AND NOT s.deleting
+            GROUP BY s.id
+            ON CONFLICT (submenu_id) DO UPDATE SET
+                menu_id = EXCLUDED.menu_id,
+                dishes_count = EXCLUDED.dishes_count,
+                fragment = EXCLUDED.fragment
+            RETURNING submenu_id, menu_id, dishes_count
+        ), counts AS (
+            SELECT submenu_id, menu_id, dishes_count FROM fragments
+            UNION ALL
+            SELECT f.submenu_id, f.menu_id, f.dishes_count
+            FROM {schema}.submenu_document f
+            JOIN {schema}.submenu s ON s.id = f.submenu_id AND NOT s.deleting
+            WHERE f.menu_id = ANY(CAST(:menu_ids AS BIGINT[]))
+            AND f.submenu_id <> ALL(CAST(:submenu_ids AS BIGINT[]))
+        ), menus AS (
+            SELECT m.id, m.title, m.description,
+                   count(c.submenu_id) AS submenus_count,
+                   coalesce(sum(c.dishes_count), 0) AS dishes_count
+            FROM {schema}.menu m
+            LEFT JOIN counts c ON c.menu_id = m.id
+            WHERE m.id = ANY(CAST(:menu_ids AS BIGINT[])) AND NOT m.deleting
+            GROUP BY m.id
+        )
+        INSERT INTO {schema}.menu_document (menu_id, detail)
+        SELECT id,
+               convert_to(CAST(json_build_object(
+                   'id', CAST(id AS TEXT),
+                   'title', title,
+                   'description', description,
+                   'submenus_count', submenus_count,
+                   'dishes_count', dishes_count
+               ) AS TEXT), 'UTF8')
+        FROM menus
+        ON CONFLICT (menu_id) DO UPDATE SET detail = EXCLUDED.detail
+        """
+    )
+
+
+def touched_submenu_ids(
     table: str,
-    conditions: Dict[str, Union[int, List[str]]] = None,
+    row_ids: List[int] = (),
+    conditions: Dict[str, Union[int, List[int]]] = None,
+    data: List[Dict[str, Any]] = (),
+) -> List[int]:
+    """
+    Подменю, статистика цен и фрагмент дерева которых меняются записью:
+    сами записанные подменю row_ids, для блюд - submenu_id из условия
+    и из записываемых строк
+    """
+    if table == "submenu":
+        return sorted(map(int, row_ids))
+    if table != "dish":
+        return []
+    submenu_id = (conditions or {}).get("submenu_id")
+    submenu_ids = set(submenu_id if isinstance(submenu_id, list) else [submenu_id])
+    submenu_ids.update(row.get("submenu_id") for row in data)
+    submenu_ids.discard(None)
+    return sorted(submenu_ids)
+
+
+async def bump_versions(
+    menu_id: int = None,
+    menu_ids: List[int] = (),
+    catalog: bool = False,
+    submenu_ids: List[int] = (),
     schema: str = "public",
+    session: AsyncSession = None,
 ) -> None:
     """
-    Удаление записи из таблицы по условию
+    Повышение версии меню menu_id, menu_ids и с catalog - версии каталога
+    (menu_id = 0, список /menus), которую меняют только записи самих меню;
+    строки блокируются по возрастанию id. В той же транзакции другим
+    процессам уходит NOTIFY об изменённых меню. Статистика цен и фрагменты
+    подменю submenu_ids и документы меню пересчитываются после блокировки версий,
+    поэтому видят зафиксированные параллельные записи
     """
-    condition_line = ""
-    if conditions is not None:
-        condition_line = "WHERE " + data_to_line(data=conditions, sep=" AND ")
-    with get_session() as session:
-        session.execute(
+    menu_ids = set(map(int, menu_ids))
+    if menu_id is not None:
+        menu_ids.add(int(menu_id))
+    if catalog:
+        menu_ids.add(CATALOG_VERSION)
+    if not menu_ids:
+        return
+    menu_ids = sorted(menu_ids)
+    async with session_scope(session) as session:
+        await session.execute(
             text(
                 f"""
-                DELETE FROM {schema}.{table}
-                {condition_line}
+                WITH bumped AS (
+                    INSERT INTO {schema}.menu_version (menu_id, version)
+                    SELECT menu_id, 1 FROM unnest(CAST(:menu_ids AS BIGINT[])) AS menu_id
+                    ON CONFLICT (menu_id) DO UPDATE
+                    SET version = menu_version.version + 1
+                )
+                SELECT pg_notify(:channel, :payload)
                 """
+            ),
+            {
+                "menu_ids": menu_ids,
+                "channel": INVALIDATION_CHANNEL,
+                "payload": invalidation_payload(menu_ids),
+            },
+        )
+        document_ids = [menu_id for menu_id in menu_ids if menu_id != CATALOG_VERSION]
+        if document_ids or submenu_ids:
+            await session.execute(
+                refresh_statement(schema),
+                {
+                    "submenu_ids": sorted(map(int, set(submenu_ids))),
+                    "menu_ids": document_ids,
+                    "price_format": PRICE_FORMAT,
+                },
             )
+
+
+async def get_version(
+    menu_id: int = None,
+    schema: str = "public",
+    session: AsyncSession = None,
+) -> int:
+    """
+    Версия меню menu_id, без него - версия всего каталога
+    """
+    async with session_scope(session) as session:
+        version = await session.execute(
+            text(
+                f"""
+                SELECT version
+                FROM {schema}.menu_version
+                WHERE menu_id = :menu_id
+                """
+            ),
+            {"menu_id": CATALOG_VERSION if menu_id is None else menu_id},
         )
-        session.commit()
+        return version.scalar() or 0
 
 
-async def update_row(
-    data: Dict[str, Union[str, int, float]],
-    table: str,
-    conditions: Dict[str, Union[int, List[str]]] = None,
+async def get_tree_version(
+    cursor: int = None,
+    limit: int = page_limit,
     schema: str = "public",
-) -> None:
+    session: AsyncSession = None,
+) -> str:
     """
-    Обновление записи по условию
+    Версия страницы /menus/tree: версия каталога (состав страницы) и сумма
+    версий её меню, которая растёт при любой записи в любое из них
     """
-    condition_line = ""
-    if conditions is not None:
-        condition_line = "WHERE " + data_to_line(data=conditions, sep=" AND ")
-    data_line = data_to_line(data=data)
-    with get_session() as session:
-        session.execute(
+    async with session_scope(session) as session:
+        version = await session.execute(
             text(
                 f"""
-                UPDATE {schema}.{table}
-                SET {data_line}
-                {condition_line}
+                SELECT
+                    (SELECT version FROM {schema}.menu_version WHERE menu_id = :catalog),
+                    (
+                        SELECT CAST(sum(v.version) AS BIGINT)
+                        FROM (
+                            SELECT id FROM {schema}.menu
+                            WHERE id > :cursor AND NOT deleting
+                            ORDER BY id LIMIT :limit
+                        ) m
+                        JOIN {schema}.menu_version v ON v.menu_id = m.id
+                    )
                 """
+            ),
+            {"catalog": CATALOG_VERSION, "cursor": cursor or 0, "limit": limit},
+        )
+        catalog, menus = version.one()
+        return f"{catalog or 0}.{menus or 0}"
+
+
+async def menu_exists(
+    menu_id: int,
+    schema: str = "public",
+    session: AsyncSession = None,
+) -> bool:
+    """
+    Проверка, что меню есть и не удаляется
+    """
+    menu = await get_rows(
+        table="menu",
+        conditions={"id": menu_id, "deleting": False},
+        schema=schema,
+        session=session,
+    )
+    return bool(menu)
+
+
+async def submenu_exists(
+    menu_id: int,
+    submenu_id: int,
+    schema: str = "public",
+    session: AsyncSession = None,
+) -> bool:
+    """
+    Проверка, что подменю принадлежит меню и не удаляется
+    """
+    submenu = await get_rows(
+        table="submenu",
+        conditions={"id": submenu_id, "menu_id": menu_id, "deleting": False},
+        schema=schema,
+        session=session,
+    )
+    return bool(submenu)
+
+
+async def delete_row(
+    table: str,
+    conditions: Dict[str, Union[int, List[int]]] = None,
+    schema: str = "public",
+    menu_id: int = None,
+    session: AsyncSession = None,
+) -> List[int]:
+    """
+    Удаление записей из таблицы по условию, возвращает их id;
+    menu_id - меню, версия которого повышается, если записи нашлись
+    """
+    async with session_scope(session) as session:
+        row_ids = await session.execute(
+            delete_statement(schema, table, conditions_shape(conditions)),
+            conditions_params(conditions),
+        )
+        row_ids = list(row_ids.scalars())
+        if row_ids:
+            await bump_versions(
+                menu_id=menu_id,
+                catalog=table == "menu",
+                submenu_ids=touched_submenu_ids(table, row_ids, conditions),
+                schema=schema,
+                session=session,
+            )
+        return row_ids
+
+
+async def update_row(
+    data: Dict[str, Union[str, int, float]],
+    table: str,
+    conditions: Dict[str, Union[int, List[int]]] = None,
+    schema: str = "public",
+    menu_id: int = None,
+    session: AsyncSession = None,
+) -> List[int]:
+    """
+    Обновление записей по условию, возвращает их id; menu_id - меню,
+    версия которого повышается, если записи нашлись
+    """
+    async with session_scope(session) as session:
+        row_ids = await session.execute(
+            update_statement(schema, table, tuple(data), conditions_shape(conditions)),
+            {f"value_{column}": value for column, value in data.items()}
+            | conditions_params(conditions),
+        )
+        row_ids = list(row_ids.scalars())
+        if row_ids:
+            await bump_versions(
+                menu_id=menu_id,
+                catalog=table == "menu",
+                submenu_ids=touched_submenu_ids(table, row_ids, conditions, [data]),
+                schema=schema,
+                session=session,
             )
+        return row_ids
+
+
+async def update_rows(
+    data: List[Dict[str, Union[str, int, float]]],
+    table: str,
+    conditions: Dict[str, Union[int, List[int]]] = None,
+    schema: str = "public",
+    menu_id: int = None,
+    session: AsyncSession = None,
+) -> List[int]:
+    """
+    Обновление записей по id из data своими значениями одним запросом
+    с дополнительным условием, возвращает id обновлённых; menu_id - меню,
+    версия которого повышается, если записи нашлись
+    """
+    if not data:
+        return []
+    columns = tuple(column for column in data[0] if column != "id")
+    rows = [{column: row[column] for column in ("id", *columns)} for row in data]
+    async with session_scope(session) as session:
+        row_ids = await session.execute(
+            update_rows_statement(schema, table, columns, conditions_shape(conditions)),
+            {"rows": json.dumps(jsonable_encoder(rows))} | conditions_params(conditions),
         )
-        session.commit()
+        row_ids = list(row_ids.scalars())
+        if row_ids:
+            await bump_versions(
+                menu_id=menu_id,
+                catalog=table == "menu",
+                submenu_ids=touched_submenu_ids(table, row_ids, conditions, data),
+                schema=schema,
+                session=session,
+            )
+        return row_ids
 
 
-async def get_rows(
+async def scale_rows(
+    column: str,
+    factor: float,
     table: str,
-    conditions: Dict[str, Union[int, List[str]]] = None,
-    schema: str = "public",
-) -> pd.DataFrame:
-    """
-    Получение записей из таблицы по условиям
-    """
-    condition_line = ""
-    if conditions is not None:
-        condition_line = "WHERE " + data_to_line(data=conditions, sep=" AND ")
-    with get_session() as session:
-        rows = pd.read_sql(
-            f"""
-            SELECT *
-            FROM {schema}.{table}
-            {condition_line}
-            """,
-            session.get_bind()
+    conditions: Dict[str, Union[int, List[int]]] = None,
+    schema: str = "public",
+    menu_id: int = None,
+    session: AsyncSession = None,
+) -> List[int]:
+    """
+    Умножение колонки на factor с округлением до сотых по условию,
+    возвращает id обновлённых; menu_id - меню, версия которого
+    повышается, если записи нашлись
+    """
+    async with session_scope(session) as session:
+        row_ids = await session.execute(
+            scale_statement(schema, table, column, conditions_shape(conditions)),
+            {"factor": factor} | conditions_params(conditions),
         )
+        row_ids = list(row_ids.scalars())
+        if row_ids:
+            await bump_versions(
+                menu_id=menu_id,
+                catalog=table == "menu",
+                submenu_ids=touched_submenu_ids(table, row_ids, conditions),
+                schema=schema,
+                session=session,
+            )
+        return row_ids
+
+
+async def get_rows(
+    table: str,
+    conditions: Dict[str, Union[int, List[int]]] = None,
+    schema: str = "public",
+    cursor: int = None,
+    limit: int = None,
+    columns: List[str] = None,
+    session: AsyncSession = None,
+) -> List[Dict[str, Any]]:
+    """
+    Получение записей из таблицы по условиям; с limit - страница
+    по возрастанию id, начиная после cursor; columns - только эти колонки
+    """
+    params = conditions_params(conditions)
+    if cursor is not None:
+        params["cursor"] = int(cursor)
+    if limit is not None:
+        params["limit"] = int(limit)
+    statement = select_statement(
+        schema,
+        table,
+        conditions_shape(conditions),
+        cursor is not None,
+        limit is not None,
+        tuple(columns) if columns else None,
+    )
+    async with session_scope(session) as session:
+        result = await session.execute(statement, params)
+        rows = list(map(dict, result.mappings()))
     return rows
 
 
+def price_text(price: ColumnElement) -> ColumnElement:
+    return func.to_char(price, PRICE_FORMAT, type_=String).label("price")
+
+
+def page_response(items: List[Dict[str, Any]], limit: int) -> ORJSONResponse:
+    """
+    Ответ со страницей списка прямо из строк запроса; items запрошены
+    с limit + 1, лишняя запись означает, что есть следующая страница
+    """
+    headers = {}
+    if len(items) > limit:
+        items = items[:limit]
+        headers["X-Next-Cursor"] = str(items[-1]["id"])
+    return ORJSONResponse(items, headers=headers)
+
+
+def search_query(query: str) -> Optional[str]:
+    """
+    tsquery из слов запроса: все слова, каждое - как префикс;
+    None, если слов нет
+    """
+    words = SEARCH_WORD.findall(query.lower())[:SEARCH_MAX_WORDS]
+    if not words:
+        return None
+    return " & ".join(f"{word}:*" for word in words)
+
+
+async def search_dishes(
+    query: str,
+    menu_id: int = None,
+    min_price: float = None,
+    max_price: float = None,
+    offset: int = 0,
+    limit: int = None,
+    schema: str = "public",
+    session: AsyncSession = None,
+) -> List[Dict[str, Any]]:
+    """
+    Блюда, найденные по названию и описанию блюда или названию подменю,
+    по убыванию релевантности; подходящие строки выбираются по GIN-индексам
+    """
+    params = {
+        "query": search_query(query),
+        "price_format": PRICE_FORMAT,
+        "offset": offset,
+        "limit": limit,
+    }
+    filters = []
+    if menu_id is not None:
+        params["menu_id"] = menu_id
+        filters.append("AND s.menu_id = :menu_id")
+    if min_price is not None:
+        params["min_price"] = min_price
+        filters.append("AND d.price >= :min_price")
+    if max_price is not None:
+        params["max_price"] = max_price
+        filters.append("AND d.price <= :max_price")
+    filter_line = " ".join(filters)
+    statement = text(
+        f"""
+        WITH search AS (
+            SELECT to_tsquery('simple', :query) AS query
+        ), found AS (
+            SELECT d.id FROM {schema}.dish d, search
+            WHERE {DISH_SEARCH_VECTOR} @@ search.query
+            UNION
+            SELECT d.id FROM {schema}.submenu s
+            JOIN {schema}.dish d ON d.submenu_id = s.id, search
+            WHERE {SUBMENU_SEARCH_VECTOR} @@ search.query
+        )
+        SELECT d.id, d.title, d.description, to_char(d.price, :price_format) AS price,
+               d.submenu_id, s.menu_id, s.title AS submenu_title,
+               ts_rank({DISH_SEARCH_VECTOR} || setweight({SUBMENU_SEARCH_VECTOR}, 'C'), search.query) AS rank
+        FROM found
+        JOIN {schema}.dish d ON d.id = found.id
+        JOIN {schema}.submenu s ON s.id = d.submenu_id AND NOT s.deleting
+        JOIN {schema}.menu m ON m.id = s.menu_id AND NOT m.deleting,
+        search
+        WHERE true {filter_line}
+        ORDER BY rank DESC, d.id
+        OFFSET :offset LIMIT :limit
+        """
+    )
+    async with session_scope(session) as session:
+        result = await session.execute(statement, params)
+        return [dict(row) for row in result.mappings()]
+
+
+async def get_menu_tree(
+    menu_id: int = None,
+    cursor: int = None,
+    limit: int = None,
+    schema: str = "public",
+    session: AsyncSession = None,
+) -> List[Dict[str, Any]]:
+    """
+    Меню с подменю, блюдами и счётчиками одним запросом; без menu_id -
+    страница всех меню по возрастанию id, начиная после cursor
+    """
+    if menu_id is not None:
+        params = {"menu_id": menu_id}
+        menu_line = "m.id = :menu_id AND NOT m.deleting"
+    else:
+        params = {"cursor": cursor or 0}
+        page_line = ""
+        if limit is not None:
+            params["limit"] = limit
+            page_line = "LIMIT :limit"
+        menu_line = f"""m.id IN (
+            SELECT id FROM {schema}.menu
+            WHERE id > :cursor AND NOT deleting
+            ORDER BY id {page_line}
+        )"""
+    query = text(
+        f"""
+        SELECT m.id AS menu_id, m.title AS menu_title, m.description AS menu_description,
+               s.id AS submenu_id, s.title AS submenu_title, s.description AS submenu_description,
+               d.id AS dish_id, d.title AS dish_title, d.description AS dish_description,
+               to_char(d.price, :price_format) AS dish_price
+        FROM {schema}.menu m
+        LEFT JOIN {schema}.submenu s ON s.menu_id = m.id AND NOT s.deleting
+        LEFT JOIN {schema}.dish d ON d.submenu_id = s.id
+        WHERE {menu_line}
+        ORDER BY m.id, s.id, d.id
+        """
+    )
+    params["price_format"] = PRICE_FORMAT
+    async with session_scope(session) as session:
+        result = await session.execute(query, params)
+        rows = result.mappings().all()
+    menus = []
+    menu = submenu = None
+    for row in rows:
+        if menu is None or menu["id"] != str(row["menu_id"]):
+            menu = {
+                "id": str(row["menu_id"]),
+                "title": row["menu_title"],
+                "description": row["menu_description"],
+                "submenus_count": 0,
+                "dishes_count": 0,
+                "submenus": [],
+            }
+            menus.append(menu)
+            submenu = None
+        if row["submenu_id"] is None:
+            continue
+        if submenu is None or submenu["id"] != str(row["submenu_id"]):
+            submenu = {
+                "id": str(row["submenu_id"]),
+                "title": row["submenu_title"],
+                "description": row["submenu_description"],
+                "dishes_count": 0,
+                "dishes": [],
+            }
+            menu["submenus"].append(submenu)
+            menu["submenus_count"] += 1
+        if row["dish_id"] is None:
+            continue
+        submenu["dishes"].append({
+            "id": str(row["dish_id"]),
+            "title": row["dish_title"],
+            "description": row["dish_description"],
+            "price": row["dish_price"],
+        })
+        submenu["dishes_count"] += 1
+        menu["dishes_count"] += 1
+    return menus
+
+
+async def get_menu_document(
+    menu_id: int,
+    document: str = "detail",
+    schema: str = "public",
+    session: AsyncSession = None,
+) -> Optional[bytes]:
+    """
+    Готовое тело ответа меню по первичному ключу: detail - меню
+    со счётчиками из menu_document, tree - оно же с фрагментами подменю
+    из submenu_document, склеенными без разбора JSON
+    """
+    if document == "detail":
+        query = f"SELECT detail FROM {schema}.menu_document WHERE menu_id = :menu_id"
+    else:
+        query = f"""
+            SELECT substring(m.detail FROM 1 FOR length(m.detail) - 1)
+                   || convert_to(', "submenus" : [', 'UTF8')
+                   || coalesce((
+                       SELECT string_agg(f.fragment, convert_to(', ', 'UTF8') ORDER BY f.submenu_id)
+                       FROM {schema}.submenu_document f
+                       WHERE f.menu_id = m.menu_id
+                   ), '')
+                   || convert_to(']}}', 'UTF8')
+            FROM {schema}.menu_document m
+            WHERE m.menu_id = :menu_id
+        """
+    async with session_scope(session) as session:
+        result = await session.execute(text(query), {"menu_id": menu_id})
+        return result.scalar()
+
+
+async def get_price_stats(
+    menu_id: int,
+    schema: str = "public",
+    session: AsyncSession = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Статистика цен меню и его подменю из submenu_price_stats одним
+    запросом без чтения блюд; None, если меню нет
+    """
+    query = text(
+        f"""
+        SELECT GROUPING(s.id) AS total, s.id,
+               CAST(coalesce(sum(p.dishes_count), 0) AS BIGINT) AS dishes_count,
+               to_char(min(p.price_min), :price_format) AS price_min,
+               to_char(max(p.price_max), :price_format) AS price_max,
+               to_char(
+                   round(sum(p.price_sum) / nullif(sum(p.dishes_count), 0), 2),
+                   :price_format
+               ) AS price_avg
+        FROM {schema}.menu m
+        LEFT JOIN {schema}.submenu s ON s.menu_id = m.id AND NOT s.deleting
+        LEFT JOIN {schema}.submenu_price_stats p ON p.submenu_id = s.id
+        WHERE m.id = :menu_id AND NOT m.deleting
+        GROUP BY ROLLUP (s.id)
+        ORDER BY total DESC, s.id
+        """
+    )
+    async with session_scope(session) as session:
+        result = await session.execute(query, {"menu_id": menu_id, "price_format": PRICE_FORMAT})
+        rows = [dict(row) for row in result.mappings()]
+    # Итоговая строка ROLLUP есть всегда; у существующего меню есть и группа
+    if len(rows) < 2:
+        return None
+    menu = rows[0]
+    del menu["total"]
+    menu["id"] = menu_id
+    menu["submenus"] = [
+        {column: value for column, value in row.items() if column != "total"}
+        for row in rows[1:]
+        if row["id"] is not None
+    ]
+    return menu
+
+
+def wants_ndjson(accept: Optional[str]) -> bool:
+    """
+    Клиент запросил построчную выдачу списка
+    """
+    return accept is not None and NDJSON in accept
+
+
+async def stream_rows(
+    query: Executable,
+    batch_size: int = stream_batch_size,
+) -> AsyncIterator[bytes]:
+    """
+    Выдача результата запроса в NDJSON через серверный курсор,
+    пачками по batch_size строк
+    """
+    async with get_async_session() as session:
+        result = await session.stream(
+            query, execution_options={"yield_per": batch_size}
+        )
+        async for rows in result.mappings().partitions():
+            yield b"".join(
+                orjson.dumps(dict(row), option=orjson.OPT_APPEND_NEWLINE)
+                for row in rows
+            )
+
+
+def ndjson_response(query: Executable) -> StreamingResponse:
+    return StreamingResponse(stream_rows(query), media_type=NDJSON)
+
+
 async def create_row(
     data: Dict[str, Union[str, int, float]],
     table: str,
     schema: str = "public",
+    menu_id: int = None,
+    session: AsyncSession = None,
 ) -> int:
     """
-    Создание записи в таблицу
+    Создание записи в таблицу; menu_id - меню,
+    версия которого повышается
     """
-    with get_session() as session:
-        values = list(map(format_value, data.values()))
-        session.execute(
-            text(
-                f"""
-                INSERT INTO {schema}.{table} ({", ".join(data)})
-                VALUES ({", ".join(values)})
-                """
-            )
-        )
-        session.commit()
+    row_ids = await create_rows(
+        data=[data],
+        table=table,
+        schema=schema,
+        menu_id=menu_id,
+        session=session,
+    )
+    return row_ids[0]
 
-        row_id = session.execute(
-            text(
-                f"""
-                SELECT id
-                FROM {schema}.{table}
-                ORDER BY id DESC
-                LIMIT 1
-                """
-            )
-        ).one()
-        return row_id[0]
+
+async def create_rows(
+    data: List[Dict[str, Union[str, int, float]]],
+    table: str,
+    schema: str = "public",
+    menu_id: int = None,
+    session: AsyncSession = None,
+) -> List[int]:
+    """
+    Создание записей в таблицу одним запросом, id в порядке data;
+    menu_id - меню, версия которого повышается (версии созданных меню
+    повышаются сами)
+    """
+    if not data:
+        return []
+    columns = tuple(data[0])
+    rows = [{column: row[column] for column in columns} for row in data]
+    async with session_scope(session) as session:
+        row_ids = await session.execute(
+            insert_statement(schema, table, columns),
+            {"rows": json.dumps(jsonable_encoder(rows))},
+        )
+        row_ids = list(row_ids.scalars())
+        await bump_versions(
+            menu_id=menu_id,
+            menu_ids=row_ids if table == "menu" else (),
+            catalog=table == "menu",
+            submenu_ids=touched_submenu_ids(table, row_ids, data=rows),
+            schema=schema,
+            session=session,
+        )
+        return row_ids
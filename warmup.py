@@ -0,0 +1,186 @@
+import asyncio
+import json
+import logging
+import time
+from os import environ
+from typing import Any, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from session import db_engine_async, db_engines_replica, db_pool_options, path_prefix
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Соединений, открываемых в каждом пуле при запуске (не больше размера пула)
+db_warm_connections = min(
+    int(environ.get("DBWARMCONNECTIONS", 2)), db_pool_options["pool_size"]
+)
+# Пауза перед повтором неудачного прогрева в секундах: удваивается
+# с каждой попыткой до db_warm_retry_max
+db_warm_retry = float(environ.get("DBWARMRETRY", 1))
+db_warm_retry_max = float(environ.get("DBWARMRETRYMAX", 30))
+# Горячие GET-маршруты: несуществующие id и курсор за концом списка
+# компилируют и подготавливают запросы, не кешируя данные каталога
+WARMUP_CURSOR = 2**31 - 1
+WARMUP_PATHS = (
+    f"/menus?cursor={WARMUP_CURSOR}&limit=1",
+    f"/menus/tree?cursor={WARMUP_CURSOR}&limit=1",
+    "/menus/0",
+    "/menus/0/tree",
+    "/menus/0/stats",
+    f"/menus/0/submenus?cursor={WARMUP_CURSOR}&limit=1",
+    "/menus/0/submenus/0",
+    f"/menus/0/submenus/0/dishes?cursor={WARMUP_CURSOR}&limit=1",
+    "/menus/0/submenus/0/dishes/0",
+)
+# Ответы прогрева без ошибок: пустой список или несуществующий id
+WARMUP_STATUSES = (200, 404)
+
+
+async def asgi_request(
+    app,
+    method: str,
+    path: str,
+    data: Any = None,
+    headers: Dict[str, str] = None,
+    content: bytes = None,
+) -> Tuple[int, bytes]:
+    """
+    Запрос к приложению напрямую через ASGI, без сети;
+    возвращает статус и полное тело ответа
+    """
+    path, _, query = path.partition("?")
+    body = content if content is not None else (
+        json.dumps(data).encode() if data is not None else b""
+    )
+    headers = {"content-type": "application/json"} | {
+        name.lower(): value for name, value in (headers or {}).items()
+    }
+    raw_headers = [(name.encode(), value.encode()) for name, value in headers.items()]
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": raw_headers,
+        "client": ("127.0.0.1", 0),
+        "server": ("localhost", 80),
+    }
+    finished = asyncio.Event()
+    request_sent = False
+    status = 0
+    chunks: List[bytes] = []
+
+    async def receive() -> Dict[str, Any]:
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: Dict[str, Any]) -> None:
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    try:
+        await app(scope, receive, send)
+    finally:
+        finished.set()
+    return status, b"".join(chunks)
+
+
+async def open_connections(engine: AsyncEngine, count: int) -> int:
+    """
+    Одновременное открытие count соединений; после возврата они
+    остаются в пуле. Возвращает число открытых соединений
+    """
+    connections = await asyncio.gather(
+        *(engine.connect() for _ in range(count)), return_exceptions=True
+    )
+    opened = [connection for connection in connections if not isinstance(connection, Exception)]
+    for connection in opened:
+        await connection.close()
+    return len(opened)
+
+
+class WarmUp:
+    """
+    Прогрев процесса: соединения в пулах и горячие запросы;
+    ready выставляется после прогрева без ошибок, до него
+    прогрев повторяется с растущей паузой
+    """
+
+    def __init__(self, started: float):
+        self.started = started
+        self.ready = False
+        self.attempts = 0
+        self.timings: Dict[str, float] = {}
+        self.connections: Dict[str, int] = {}
+        self.error: Optional[str] = None
+
+    async def attempt(self, app) -> None:
+        """
+        Одна попытка прогрева; исключение, если какой-то пул не открыл
+        ни одного соединения или горячий запрос завершился ошибкой
+        """
+        began = time.perf_counter()
+        engines = [("async", db_engine_async)] + [
+            (f"replica{index}", engine) for index, engine in enumerate(db_engines_replica)
+        ]
+        counts = await asyncio.gather(
+            *(open_connections(engine, db_warm_connections) for _, engine in engines)
+        )
+        self.connections = {name: count for (name, _), count in zip(engines, counts)}
+        failed = [name for name, count in self.connections.items() if not count]
+        if failed:
+            raise ConnectionError(f"no connections opened: {', '.join(failed)}")
+        connected = time.perf_counter()
+        self.timings["connections"] = connected - began
+        for path in WARMUP_PATHS:
+            status, body = await asgi_request(app, "GET", path_prefix + path)
+            if status not in WARMUP_STATUSES:
+                raise RuntimeError(f"GET {path}: {status} {body[:200].decode(errors='replace')}")
+        self.timings["queries"] = time.perf_counter() - connected
+
+    async def run(self, app) -> None:
+        self.timings["import"] = time.perf_counter() - self.started
+        delay = db_warm_retry
+        while True:
+            self.attempts += 1
+            try:
+                await self.attempt(app)
+                break
+            except Exception as exception:
+                # Процесс обслуживает запросы и без прогрева, но /ready - нет
+                self.error = str(exception)
+                logger.warning(
+                    "warm-up attempt %d failed, retry in %.1f s: %s",
+                    self.attempts, delay, exception,
+                )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, db_warm_retry_max)
+        self.error = None
+        self.timings["startup"] = time.perf_counter() - self.started
+        self.ready = True
+        logger.info("startup finished in %.3f s: %s", self.timings["startup"], self.timings)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "seconds": {name: round(value, 4) for name, value in self.timings.items()},
+            "connections": self.connections,
+            "attempts": self.attempts,
+            "error": self.error,
+        }